@@ -1,13 +1,19 @@
 import os, sys
+from supr.startup import importprofile
+startup = importprofile('--profile-startup' in sys.argv)
 from datetime import timedelta
 import logging
-import yaml
+import pickle
+import hashlib
 
 DEBUG = os.environ.get('DEBUG', False)
 DIR = os.path.dirname(os.path.abspath(__file__))
 CONF_PATH = os.environ.get('SUPR_CONF', 'supr.yaml')
 DB_PATH = os.environ.get('SUPR_DB', '.supr.db')
 LOG_PATH = os.environ.get('SUPR_LOG', '.supr.log')
+POOL_PATH = os.environ.get('SUPR_POOL', '.supr.pool')
+INVENTORY_PATH = os.environ.get('SUPR_INVENTORY', '.supr.inventory')
+CONF_CACHE_PATH = os.environ.get('SUPR_CONF_CACHE', '.supr.conf')
 CONF_DEFAULTS = {
     # `stop` idle hosts after a period of activity. default: disabled
     'IDLE_TIMEOUT': None, 
@@ -16,6 +22,38 @@ CONF_DEFAULTS = {
     # packages needed to support supr features
     'APT_ESSENTIAL': ('rsync', 's3fs', 'git-core', 'python3', 'python3-pip', 'python3-venv'), 
     'PIP_ESSENTIAL': ('wheel', 'setuptools'), 
+    # max instances operated on concurrently by `supr fleet`
+    'FLEET_WORKERS': 8, 
+    # `supr fleet` relays `local:` packages host to host, each sending to this many at once
+    'FANOUT_WIDTH': 4, 
+    # upload to this instance (e.g. your supervisor) first instead of the first target
+    'FANOUT_SEED': None, 
+    # `put` and `local:` send files this large over parallel, resumable streams (see `supr.transfer`)
+    'BULK_THRESHOLD': 64 * 1024 * 1024, 
+    'BULK_STREAMS': 4, 
+    'BULK_CHUNK': 32 * 1024 * 1024, 
+    # compress bulk transfers on the wire: `zstd` (needs the zstandard module and `zstd` on the host) or `gzip`
+    'BULK_COMPRESS': None, 
+    'BULK_LOCAL': True, 
+    # OpenSSH connection sharing for rsync; sockets outlive the `supr` process
+    'SSH_CONTROL_PATH': '~/.ssh/supr-%C', 
+    'SSH_CONTROL_PERSIST': '10m', 
+    # seconds `supr list` and name lookups are served from the inventory snapshot; 0 disables
+    'INVENTORY_TTL': 60, 
+    # `supr fleet` tees each host's output to a rotating log in this directory
+    'STREAM_LOG_DIR': None, 
+    'STREAM_LOG_BYTES': 10 * 1024 * 1024, 
+    'STREAM_LOG_BACKUPS': 3, 
+    # days of `supr trace` timings kept by the cron job
+    'SPAN_RETENTION_DAYS': 30, 
+    # a host whose agent reports more than any of these, averaged over IDLE_TIMEOUT, 
+    # isn't idle: percent, percent, bytes/s, bytes/s
+    'IDLE_CPU': 10, 
+    'IDLE_GPU': 5, 
+    'IDLE_NET': 50_000, 
+    'IDLE_DISK': 1_000_000, 
+    # days of utilization samples kept for `rightsize`
+    'SAMPLE_RETENTION_DAYS': 30, 
 }
 ANSI = dict([
     (v, "\033[%sm" % i) for v, i in \
@@ -24,19 +62,42 @@ ANSI = dict([
 ])
 
 class conf(dict):
+    @staticmethod
+    def _yaml():
+        import yaml
+        loader = getattr(yaml, 'CLoader', yaml.Loader)
+        loader.add_constructor('tag:yaml.org,2002:map', lambda l, n: conf(l.construct_mapping(n)))
+        yaml.SafeDumper.add_representer(conf, lambda d, x: d.represent_dict(x))
+        return yaml, loader
     @classmethod
-    def load(cls, filename):
-        return yaml.load(open(filename), Loader=yaml.Loader)
+    def load(cls, filename, cache=CONF_CACHE_PATH):
+        """
+        Parse `filename`, or reuse the resolved config pickled in `cache` 
+        if it was compiled from identical contents.
+        """
+        with open(filename, 'rb') as f: src = f.read()
+        key = hashlib.sha1(src).hexdigest()
+        try:
+            with open(cache, 'rb') as f: cached_key, c = pickle.load(f)
+            if cached_key == key: return c
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError): pass
+        yaml, loader = cls._yaml()
+        c = yaml.load(src, Loader=loader)
+        try:
+            with open(cache + '.tmp', 'wb') as f: pickle.dump((key, c), f)
+            os.replace(cache + '.tmp', cache)
+        except OSError: pass
+        return c
     def __str__(self):
+        yaml, _ = self._yaml()
         return yaml.dump(self, default_flow_style=False, Dumper=yaml.SafeDumper)
     def __getattr__(self, key):
+        if key.startswith('__'): raise AttributeError(key)
         return self[key]
-    def __getitem__(self, key):
-        assert key in self, f'"{key}" not found'
-        return super().__getitem__(key)
-yaml.Loader.add_constructor('tag:yaml.org,2002:map', lambda l, n: conf(l.construct_mapping(n)))
-yaml.SafeDumper.add_representer(conf, lambda d, x: d.represent_dict(x))
+    def __missing__(self, key):
+        assert False, f'"{key}" not found'
 CONF = {**CONF_DEFAULTS, **conf.load(CONF_PATH)}
+startup.phase('config')
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG if DEBUG else logging.INFO)
@@ -44,6 +105,7 @@ log.addHandler(logging.FileHandler(LOG_PATH))
 
 from supr.state import localstate
 state = localstate(DB_PATH, CONF['IDLE_TIMEOUT'])
+startup.phase('state')
 
 if 'local' in CONF:
     from supr.backend import local
@@ -53,6 +115,10 @@ elif 'aws' in CONF:
     from supr.backend import aws
     backend = aws.backend()
     instance = aws.instance
+elif 'fake' in CONF:
+    from supr.backend import fake
+    backend = fake.backend()
+    instance = fake.instance
 else:
     assert False, "no backend configured"
-
+startup.phase('backend')
@@ -1,7 +1,8 @@
 import sys
 import traceback
 from supr.backend import F_STATE, F_ACTIVE
-from supr import CONF, DEBUG, instance, backend, state
+from supr import CONF, DEBUG, instance, backend, state, startup
+from supr.fleet import fleet as _fleet
 
 def help():
     print("usage: supr [command] [args] | [instance] [command] [args]")
@@ -9,16 +10,44 @@ def help():
     for k, v in globals().items():
         if k.startswith('_'): continue
         if callable(v): print(f"  {k}")
-def costs():
-    for aws_id, runtime in state.get_runtime():
-        i = backend.get_instance_by_id(aws_id)
-        hours = runtime / 60 / 60
-        print("{runtime:0.2f}h {name} ${cost:0.2f}".format(
-            runtime=hours, 
-            name=i.name, 
-            cost=hours * i.conf['hour_cost']))
+def costs(*args):
+    # supr costs [--since YYYY-MM-DD] [--until YYYY-MM-DD] [--by instance|name]
+    opts = dict(zip(args[::2], args[1::2]))
+    assert set(opts).issubset({'--since', '--until', '--by'}), f"invalid options {' '.join(args)}"
+    assert opts.get('--by', 'instance') in ('instance', 'name'), "--by must be instance or name"
+    from supr.backend import conf_name
+    def describe(ids):
+        named = [(i.id, i.name, CONF.get(conf_name(i.name))) for i in backend.describe_many(ids)]
+        return {_id: (name, conf.get('hour_cost') if isinstance(conf, dict) else None) for _id, name, conf in named}
+    state.backfill_runtime(describe)
+    rows = state.get_costs(
+        opts.get('--since', '0000-01-01'), 
+        opts.get('--until', '9999-12-31'), 
+        opts.get('--by') == 'name')
+    for key, name, runtime, cost in rows:
+        # runtime recorded before names were, for instances that are long gone
+        print("{runtime:0.2f}h {name} {cost}".format(
+            runtime=runtime / 60 / 60, 
+            name=name or key or 'unnamed', 
+            cost=f"${cost:0.2f}" if name else "cost unknown"))
+    print("{runtime:0.2f}h total ${cost:0.2f}".format(
+        runtime=sum(r[2] for r in rows) / 60 / 60, 
+        cost=sum(r[3] for r in rows)))
+
+def _submit(target, cmd, *args):
+    # supr fleet [target] submit [hook] [args] [--items FILE]
+    from supr import jobs
+    items = None
+    if '--items' in args:
+        n = args.index('--items')
+        assert n + 1 < len(args), "--items needs a file with one item per line"
+        with open(args[n + 1]) as f: items = [l.rstrip('\n') for l in f if l.strip()]
+        args = args[:n] + args[n + 2:]
+    job_id = jobs.submit(_fleet.select(target), cmd, *args, items=items)
+    print(f"submitted job {job_id}; follow it with `supr jobs {job_id} wait`")
 
 def main():
+    if startup.enabled: sys.argv.remove('--profile-startup')
     def i(n, f=F_ACTIVE):
         x = backend.get_instance(n, f)
         print(x); return x if x else None
@@ -26,34 +55,56 @@ def main():
         [print(x) for x in backend.get_instances(*f)]
     def create(n, do_init=True):
         if i(n): print(f"instance {n} already exists"); return
-        instance.new(n)
-        i.init(); i(n) if do_init else None
+        x = instance.claim(n)
+        if not x:
+            x = instance.new(n)
+            x.init() if do_init else None
+        i(n)
     match sys.argv[1:]:
+        case ['help']: help()
         case ['list']: p(F_ACTIVE)
         case ['list', 'all']: p(F_STATE['*'])
         case ['list', state]: p(F_STATE[state])
-        case ['costs']: costs()
+        case ['costs', *args]: costs(*args)
+        case ['trace']: from supr.spans import report; report()
+        case ['trace', name]: from supr.spans import report; report(name)
+        case ['pool']: from supr.pool import pool; pool().serve()
+        case ['fleet', target, 'submit', cmd, *args]: _submit(target, cmd, *args)
+        case ['jobs']: from supr.jobs import report; report()
+        case ['jobs', job_id]: from supr.jobs import report, report_items; report(job_id); report_items(job_id)
+        case ['jobs', job_id, 'wait']: from supr.jobs import wait; wait(job_id)
+        case ['jobs', job_id, item_no]: print((state.get_job_output(job_id, int(item_no)) or ('', ))[0] or '')
+        case ['fleet', target, cmd, *args]: _fleet.summary(_fleet.select(target).call(cmd, *args))
         case [name, 'conftest']: print(CONF[name])
         case [name, 'create']: create(name)
         case [name, 'create', '--no_init']: create(name, False)
+        case [name, 'fill_pool']: instance.fill_pool(name)
+        case [name, 'bake']: instance.bake(name)
+        case [name, 'scale', n]: instance.scale(name, int(n))
+        case [name, 'rightsize']: from supr.utilization import rightsize; rightsize(name)
+        case [name, 'rightsize', days]: from supr.utilization import rightsize; rightsize(name, int(days))
         case [name, 'start']: i(name).start(); i(name)
         case [name, 'stop']: i(name).stop(); i(name)
         case [name, 'snapshot']: i(name).snapshot(); i(name)
         case [name, 'terminate']: input('terminate? (^c to cancel)'); i(name).terminate(); i(name, F_STATE['*'])
         case [name, 'ssh']: i(name).ssh()
         case [name, 'run', cmd, *args]: i(name).run(cmd, *args)
+        case [name, 'put', local, remote]: i(name).put(local, remote)
         case [name, 'install', src, pkg]: i(name).install(src, pkg)
         case [name, 'install_essential']: i(name).install_essential()
         case [name, 'install_base']: i(name).install_base()
+        case [name, 'install_base', '--force']: i(name).install_base(force=True)
         case [name, 'install_crontab']: i(name).install_crontab()
         case [name, 'attach_volumes']: i(name).attach_volumes()
         case [name, 'deploy']: i(name).deploy()
+        case [name, 'deploy', '--force']: i(name).deploy(force=True)
         case [name, cmd]: i(name).hook(cmd)
         case [name, cmd, *args]: i(name).hook(cmd, *args)
         case _: print("invalid command"); p(F_ACTIVE)
 
 if __name__ == '__main__':
-    try: main()
+    startup.phase('__main__')
+    try: main(); startup.phase('command'); startup.report()
     except AssertionError as e:
         print(traceback.format_exc()) if DEBUG else print(f"invalid config: {e}")
     except Exception as e: raise e
\ No newline at end of file
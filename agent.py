@@ -0,0 +1,67 @@
+"""
+Utilization sampler copied to every host and run from its crontab by
+`install_crontab`; standard library only, since it runs on the system
+python. Each run appends one line to `~/.supr/samples`:
+
+    unixtime cpus cpu% gpus gpu% net_bytes/s disk_bytes/s
+
+Rates are averaged since the previous run, whose counters are kept in
+`~/.supr/agent.state`. `supr.cron` collects and truncates the samples.
+"""
+import os
+import json
+import time
+import subprocess
+
+DIR = os.path.expanduser('~/.supr')
+# the supervisor normally collects every few minutes; don't grow forever if it doesn't
+MAX_SAMPLES = 10080
+
+
+def cpu():
+    with open('/proc/stat') as f: fields = [int(x) for x in f.readline().split()[1:]]
+    # idle + iowait
+    return sum(fields), fields[3] + fields[4]
+
+def net():
+    with open('/proc/net/dev') as f: lines = f.readlines()[2:]
+    return sum(int(l.split(':')[1].split()[0]) + int(l.split(':')[1].split()[8])
+        for l in lines if l.split(':')[0].strip() != 'lo')
+
+def disk():
+    with open('/proc/diskstats') as f: rows = [l.split() for l in f]
+    # whole devices only; sectors are 512 bytes regardless of the device
+    return sum((int(r[5]) + int(r[9])) * 512 for r in rows
+        if not r[2].startswith(('loop', 'ram')) and os.path.exists(f"/sys/block/{r[2]}"))
+
+def gpu():
+    try:
+        r = subprocess.run(['nvidia-smi', '--query-gpu=utilization.gpu', '--format=csv,noheader,nounits'],
+            capture_output=True, text=True, timeout=10)
+        used = [float(x) for x in r.stdout.split()] if r.returncode == 0 else []
+    except (OSError, subprocess.TimeoutExpired, ValueError): used = []
+    return len(used), sum(used) / len(used) if used else 0
+
+def main():
+    os.makedirs(DIR, exist_ok=True)
+    now, (total, idle), rx, io = time.time(), cpu(), net(), disk()
+    try:
+        with open(os.path.join(DIR, 'agent.state')) as f: last = json.load(f)
+    except (OSError, ValueError): last = None
+    with open(os.path.join(DIR, 'agent.state'), 'w') as f:
+        json.dump(dict(t=now, total=total, idle=idle, net=rx, disk=io), f)
+    # counters restart with the host (or came with a baked image)
+    if not last or not 0 < now - last['t'] < 600 or total < last['total']: return
+    dt = now - last['t']
+    busy = 100 * (1 - (idle - last['idle']) / max(1, total - last['total']))
+    gpus, gpu_used = gpu()
+    sample = f"{now:.0f} {os.cpu_count()} {busy:.1f} {gpus} {gpu_used:.1f} " \
+        f"{max(0, rx - last['net']) / dt:.0f} {max(0, io - last['disk']) / dt:.0f}\n"
+    path = os.path.join(DIR, 'samples')
+    with open(path, 'a') as f: f.write(sample)
+    if os.path.getsize(path) > MAX_SAMPLES * 64:
+        with open(path) as f: lines = f.readlines()[-MAX_SAMPLES:]
+        with open(path, 'w') as f: f.writelines(lines)
+
+if __name__ == '__main__':
+    main()
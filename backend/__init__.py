@@ -1,12 +1,19 @@
-import time
+import os
+import re
+import sys
+import json
+import shlex
+import hashlib
+import tempfile
 import threading
 import abc
 from pathlib import PurePath as path
-import uuid
-import fabric, paramiko
-from patchwork.transfers import rsync
-from patchwork.files import exists
+from fnmatch import fnmatch
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
 from supr import CONF, ANSI, state, log
+from supr.ready import backoff, port_open, timed
+from supr.spans import span, phase, traced
 
 class F:
     """
@@ -25,44 +32,77 @@ F_STATE = F('instance-state-name')
 F_ACTIVE = F_STATE['pending', 'running', 'stopping', 'stopped']
 F_NAME = F('tag:Name')
 
-class sshclient(paramiko.SSHClient):
+# warm pool and image baking instances are named after their config with a suffix
+POOL_SUFFIX = '.pool'
+BAKE_SUFFIX = '.bake'
+# members of a scaling group are named after their config with an index
+MEMBER_PATTERN = re.compile(r'^(.+)-(\d+)$')
+def group_member(name) -> tuple[str, int] | None:
     """
-    Hacks paramiko to provide a callback for activity.
+    `(group, index)` if `name` is a member of a scaling group.
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.activity_callback = lambda: None # override this
-    def connect(self, *args, **kwargs):
-        kwargs['transport_factory'] = self._get_transport_factory()
-        super().connect(*args, **kwargs)
-    def _get_transport_factory(self):
-        def wrap(original, callback):
-            last_call = time.time()
-            def _wrap(*args, **kwargs):
-                nonlocal last_call
-                if time.time() - last_call > 1:
-                    threading.Thread(target=callback).start()
-                    last_call = time.time()
-                return original(*args, **kwargs)
-            return _wrap
-        def factory(*args, **kwargs):
-            from paramiko.common import MSG_CHANNEL_DATA
-            transport = paramiko.transport.Transport(*args, **kwargs)
-            _feed = transport._channel_handler_table[MSG_CHANNEL_DATA]
-            transport._channel_handler_table[MSG_CHANNEL_DATA] = wrap(_feed, self.activity_callback)
-            return transport
-        return factory
-class connection(fabric.Connection):
+    m = MEMBER_PATTERN.match(name or '')
+    if not m or name in CONF or m[1] not in CONF: return None
+    return m[1], int(m[2])
+def conf_name(name) -> str:
     """
-    Extends fabric.Connection to provide a callback for activity.
-    Pass your callback as `activity_callback` to the constructor.
+    The config section an instance name belongs to.
     """
-    def __init__(self, *args, **kwargs):
-        activity_callback = kwargs.pop('activity_callback', lambda: None)
-        super().__init__(*args, **kwargs)
-        self.client = sshclient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.client.activity_callback = activity_callback
+    for suffix in (POOL_SUFFIX, BAKE_SUFFIX):
+        if name.endswith(suffix): return name[:-len(suffix)]
+    if member := group_member(name): return member[0]
+    return name
+
+# connections are shared by every instance object for the same host in a process
+_connections = {}
+_connections_lock = threading.Lock()
+# pool instances are listed and claimed one at a time within a process
+_claim_lock = threading.Lock()
+
+def _hash_specs(specs) -> str:
+    return hashlib.sha1('\n'.join(sorted(specs)).encode()).hexdigest()
+
+LOCAL_META = ('pyproject.toml', 'setup.py', 'setup.cfg')
+def _hash_tree(root, exclude) -> tuple[str, str]:
+    """
+    Content hash of a local project and of its packaging metadata.
+    """
+    tree, meta = hashlib.sha1(), hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not any(fnmatch(d, x) for x in exclude))
+        for f in sorted(filenames):
+            if any(fnmatch(f, x) for x in exclude): continue
+            p = os.path.join(dirpath, f)
+            h = hashlib.sha1(os.path.relpath(p, root).encode())
+            with open(p, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''): h.update(chunk)
+            tree.update(h.digest())
+            if dirpath == root and f in LOCAL_META: meta.update(h.digest())
+    return tree.hexdigest(), meta.hexdigest()
+
+def _rsync_stats(stdout) -> tuple[int, int]:
+    files = re.search(r"Number of (?:regular )?files transferred: ([\d,]+)", stdout)
+    sent = re.search(r"Total bytes sent: ([\d,]+)", stdout)
+    return tuple(int(m.group(1).replace(',', '')) if m else 0 for m in (files, sent))
+
+def _dump_json(data, filename):
+    """
+    Replace `filename` with `data` in one step; concurrent writers each use their own temp file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f: json.dump(data, f)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp); raise
+
+def _megabytes(size) -> int:
+    """
+    `10G`, `512M`, ... to megabytes; plain numbers are already megabytes.
+    """
+    if isinstance(size, (int, float)): return int(size)
+    units = dict(K=1 / 1024, M=1, G=1024, T=1024 * 1024)
+    return int(float(size[:-1]) * units[size[-1].upper()]) if size[-1].upper() in units else int(size)
 
 class _abstractinstance(metaclass=abc.ABCMeta):
     """
@@ -82,13 +122,17 @@ class _abstractinstance(metaclass=abc.ABCMeta):
     def wait_until_stopped(self) -> None: pass
     def wait_until_terminated(self) -> None: pass
     def _attach_volume(self, name) -> None: pass
+    def _rename(self, name) -> None: pass
+    def _tag(self, key) -> str: pass
+    def _refresh(self) -> None: pass
 
 class _instance:
     """
     Shared logic for instance implementations.
     """
-    conf = property(lambda self: CONF.get(self.name, {}))
+    conf = property(lambda self: CONF.get(conf_name(self.name), {}))
     is_super = property(lambda self: self.conf.get('super', False))
+    member_index = property(lambda self: (group_member(self.name) or (None, None))[1])
     user = property(lambda self: self.conf['user'])
     group = property(lambda self: self.conf.get('group', self.user))
     home = property(lambda self: path("/home")/self.conf['user'])
@@ -96,23 +140,153 @@ class _instance:
     py_bin = property(lambda self: self.env/'bin/python')
     pip_bin = property(lambda self: self.env/'bin/pip')
     dist_release = property(lambda self: self.conf['dist_release'])
-    apt_cache = property(lambda self: path(self.conf['apt_cache']) if 'apt_cache' in self.conf else None)
-    wheel_cache = property(lambda self: path(self.conf['wheel_cache']) if 'wheel_cache' in self.conf else None)
+    apt_cache = property(lambda self: path(self.conf['apt_cache']) if 'apt_cache' in self.conf else \
+        self.artifact_cache and self.artifact_cache.debs)
+    wheel_cache = property(lambda self: path(self.conf['wheel_cache']) if 'wheel_cache' in self.conf else \
+        self.artifact_cache and self.artifact_cache.wheels)
     _storage_handlers = [
         ('native', lambda self, name: self.mount(name)), 
         ('swap', lambda self, name: self.swap(name))
     ]
     @classmethod
-    def new(cls, name):
+    @traced('create')
+    def new(cls, name, baked=True):
+        from supr import backend
+        with timed(name, 'create'):
+            i = backend.create_instance(name, baked)
+        state.change(i.id, 'start', name, cls.get_conf(name).get('hour_cost'))
+        print(f"creating {name}...")
+        with timed(name, 'running'):
+            i.wait_until_running()
+        i.wait_until_connectable()
+        return i
+    @classmethod
+    def claim(cls, name):
+        """
+        Take an initialized instance from `name`'s warm pool and start it.
+        """
         from supr import backend
-        i = backend.create_instance(name)
-        state.change(i.id, 'start')
-        print(f"creating {i.name}...")
-        i.wait_until_running()
-        while True:
-            try: i.connection.open(); break
-            except paramiko.ssh_exception.NoValidConnectionsError: time.sleep(2)
+        pool_name = conf_name(name) + POOL_SUFFIX
+        with _claim_lock:
+            pooled = [i for i in backend.get_instances(F_NAME[pool_name], F_STATE['stopped'])
+                if i.name == pool_name]
+            # the state database arbitrates between processes
+            i = next((i for i in pooled if state.claim_pool_instance(i.id, name)), None)
+            if not i: return None
+            i._rename(name)
+            backend.invalidate()
+        # only a claim that happens counts as `create`; otherwise `new` records it
+        with phase(name, 'create'):
+            print(f"claiming {i.id} from the warm pool...")
+            i.start()
+            i.wait_until_connectable()
+            i.cmd('sudo hostname %s' % name)
+            i.attach_volumes()
         return i
+    @classmethod
+    def fill_pool(cls, name):
+        """
+        Create, initialize and stop instances until `name` has `warm_pool` 
+        stopped instances ready to be claimed.
+        """
+        from supr import backend
+        want = cls.get_conf(name).get('warm_pool', 0)
+        have = backend.get_instances(F_NAME[name + POOL_SUFFIX], F_ACTIVE)
+        def prewarm(_):
+            i = cls.new(name + POOL_SUFFIX)
+            # volumes can only be attached to one instance; `claim` attaches them
+            i.init(volumes=False)
+            i.stop()
+        with ThreadPoolExecutor(max_workers=CONF['FLEET_WORKERS']) as pool:
+            futures = [pool.submit(prewarm, n) for n in range(want - len(have))]
+        for f in futures:
+            if f.exception(): log.error(f"[supr.pool] {name}: {f.exception()}")
+    @classmethod
+    def members(cls, name) -> list['_instance']:
+        from supr import backend
+        return sorted([i for i in backend.get_instances(F_NAME[f"{name}-*"], F_ACTIVE)
+            if (group_member(i.name) or (None, ))[0] == name], key=lambda i: i.member_index)
+    @classmethod
+    def scale(cls, name, n):
+        """
+        Bring the group `name` to `n` running members, `name-0` to `name-{n-1}`,
+        in parallel: missing members are claimed from the warm pool or created,
+        stopped ones are started and any past `n` are stopped.
+        """
+        from supr import backend
+        assert isinstance(CONF.get(name), dict), f"{name} not found"
+        have = {i.name: i for i in cls.members(name)}
+        def up(member):
+            if i := cls.claim(member): return i
+            i = cls.new(member)
+            i.init()
+            return i
+        def restart(instances):
+            [i.wait_for_state('stopped', 'running') for i in instances if i.state in ('stopping', 'pending')]
+            backend.start_many([i for i in instances if i.state == 'stopped'])
+        members = [f"{name}-{k}" for k in range(n)]
+        with ThreadPoolExecutor(max_workers=CONF['FLEET_WORKERS']) as pool:
+            futures = {m: pool.submit(up, m) for m in members if m not in have}
+            futures.update(dict.fromkeys([m for m in members if m in have],
+                pool.submit(restart, [have[m] for m in members if m in have])))
+            extra = [i for i in have.values() if i.member_index >= n and i.state == 'running']
+            backend.stop_many(extra)
+        for member, f in futures.items():
+            if f.exception(): log.error(f"[supr.scale] {member}: {f.exception()}")
+        running = len([f for f in futures.values() if not f.exception()])
+        print(f"{name}: {running}/{n} running, {len(extra)} stopped")
+    @classmethod
+    def image_hash(cls, name) -> str:
+        """
+        Identifies everything a baked image for `name` has preinstalled.
+        """
+        conf = cls.get_conf(name)
+        inputs = dict(
+            ami=conf.get('aws:ami'), 
+            dist_release=conf.get('dist_release'), 
+            apt_sources=conf.get('apt_sources', ()), 
+            env=conf.get('env'), 
+            essential=(CONF['APT_ESSENTIAL'], CONF['PIP_ESSENTIAL']), 
+            base=conf.get('packages', {}).get('base', ()))
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+    @classmethod
+    def bake(cls, name):
+        """
+        Build an image for `name` with essential and base packages installed;
+        `create` launches from the newest one whose hash still matches.
+        """
+        h = cls.image_hash(name)
+        i = cls.new(name + BAKE_SUFFIX, baked=False)
+        try:
+            i.cmd('sudo hostname %s' % name)
+            i.install_essential()
+            i.install_base()
+            # image names are unique; rebaking the same inputs (e.g. for OS updates) gets a new one
+            from datetime import datetime, timezone
+            stamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+            id_ = i._snapshot(f"{name}-{h}-{stamp}", {'supr:config': name, 'supr:image-hash': h})
+            print(f"{name}: {id_} ({h})")
+        finally:
+            # the bake instance shares `name`'s config, `super` included
+            i.terminate(force=True)
+    baked = property(lambda self: self._tag('supr:image-hash') == self.image_hash(self.name))
+    def wait_for_state(self, *states):
+        def check():
+            self._refresh()
+            assert self.state != 'terminated' or 'terminated' in states, f"{self.name} was terminated"
+            return self.state in states
+        backoff(check, what=f"{self.name} {'|'.join(states)}")
+    def wait_until_connectable(self):
+        from paramiko.ssh_exception import NoValidConnectionsError
+        # only sshd not answering yet is worth waiting for; a bad key or host key isn't
+        def handshake():
+            try: self.connection.open(); return True
+            except (NoValidConnectionsError, OSError): return False
+        # probe the port first; sshd comes up well after the instance is "running"
+        with timed(self.name, 'port'):
+            backoff(lambda: port_open(self.private_ip_address), what=f"{self.name}:22")
+        with timed(self.name, 'ssh'):
+            backoff(handshake, what=f"{self.name} ssh")
     def __repr__(self) -> str:
         return "".join([
             "{%s}{state}{RST} " % ("GRN" if self.state == 'running' else "RED"), 
@@ -131,95 +305,188 @@ class _instance:
         ), **ANSI)
     @staticmethod
     def get_conf(name):
-        return CONF[name]
+        return CONF[conf_name(name)]
     @property
-    def connection(self) -> connection:
+    def connection(self) -> 'connection':
         assert {'user', 'env', 'key_pair'}.issubset(self.conf), f"missing user, env, key_pair in config"
         assert 'file' in self.conf['key_pair'], f"missing key_pair.file in config"
         if not hasattr(self, '_connection'):
-            self._connection = connection(
-                self.private_ip_address, 
-                user=self.user, 
-                connect_kwargs=dict(key_filename=self.conf['key_pair']['file']), 
-                inline_ssh_env=True, 
-                activity_callback=state.activity_callback(self.id))
+            key = (self.private_ip_address, self.user)
+            with _connections_lock:
+                if key not in _connections: _connections[key] = self._connect()
+            self._connection = _connections[key]
         return self._connection
+    def _connect(self) -> 'connection':
+        """
+        A new, unshared connection; see `supr.transfer` for why you'd want more than one.
+        """
+        from supr.ssh import connection
+        return connection(
+            self.private_ip_address, 
+            user=self.user, 
+            connect_kwargs=dict(key_filename=self.conf['key_pair']['file']), 
+            inline_ssh_env=True, 
+            activity_callback=state.activity_callback(self.id))
+    @property
+    def artifact_cache(self) -> 'artifactcache':
+        if 'artifact_cache' not in self.conf: return None
+        if not hasattr(self, '_artifact_cache'):
+            from supr.cache import artifactcache
+            self._artifact_cache = artifactcache(self)
+        return self._artifact_cache
+    @property
+    def ssh_opts(self) -> str:
+        # OpenSSH multiplexing for the tools we shell out to (rsync)
+        return ' '.join([
+            "-o ControlMaster=auto", 
+            f"-o ControlPath={CONF['SSH_CONTROL_PATH']}", 
+            f"-o ControlPersist={CONF['SSH_CONTROL_PERSIST']}", ])
     @property
     def vars(self):
         return self.conf.get('vars', {})
     def start(self):
-        state.change(self.id, 'start')
-        self._start()
-        self.wait_until_running()
+        from supr import backend
+        with timed(self.name, 'start'):
+            self._start()
+            state.change(self.id, 'start', self.name, self.conf.get('hour_cost'))
+            backend.invalidate()
+            self.wait_until_running()
     def stop(self):
-        self._stop()
-        self.wait_until_stopped()
+        from supr import backend
+        with timed(self.name, 'stop'):
+            self._stop()
+            backend.invalidate()
+            self.wait_until_stopped()
         state.change(self.id, 'stop')
-    def init(self):
+    @traced('init')
+    def init(self, volumes=True):
         self.cmd('sudo hostname %s' % self.name)
         self.connection.local(f"ssh-keyscan {self.private_ip_address} >> ~/.ssh/known_hosts")
-        self.install_essential()
-        self.attach_volumes()
-        self.install_base()
+        baked = self.baked
+        if not baked: self.install_essential()
+        if volumes: self.attach_volumes()
+        if not baked: self.install_base()
         self.install_crontab()
     def snapshot(self):
+        import uuid
         id_ = self._snapshot(f"{self.name}-snapshot-{uuid.uuid4().hex}")
         print(f"{self.name}: {id_}")
-    def terminate(self):
-        if self.is_super: print("you probably don't want to do that"); return
+    def terminate(self, force=False):
+        if self.is_super and not force: print("you probably don't want to do that"); return
+        from supr import backend
         self._terminate()
+        backend.invalidate()
         self.wait_until_terminated()
         state.change(self.id, 'stop')
-    def run(self, cmd, *args, **kwargs):
+    def run(self, cmd, *args, pooled=True, **kwargs):
+        """
+        `pooled=False` skips `supr pool`, whose connections record activity
+        in the daemon, out of reach of `state.recorder.paused()`.
+        """
+        from supr.pool import pool
         state.activity(self.id)
-        return self.connection.run(cmd, env=self.vars, *args, **kwargs)
+        with span('cmd', cmd, self.name):
+            if pooled and not args and not kwargs.get('pty') and pool.available():
+                try: return self._run_pooled(cmd, **kwargs)
+                except ConnectionError as e: log.debug(e)
+            return self.connection.run(cmd, env=self.vars, *args, **kwargs)
+    def _run_pooled(self, cmd, hide=False, warn=False, **kwargs):
+        from invoke.runners import Result
+        from invoke.exceptions import UnexpectedExit
+        from supr.pool import pool
+        stdout, stderr, exited = pool.run(self.id, cmd, **kwargs)
+        if not hide:
+            sys.stdout.write(stdout); sys.stderr.write(stderr)
+        r = Result(stdout=stdout, stderr=stderr, command=cmd, env=self.vars, exited=exited, hide=('stdout', 'stderr') if hide else ())
+        if r.failed and not warn: raise UnexpectedExit(r)
+        return r
     cmd = run
+    def stream(self, cmd):
+        """
+        Run `cmd` and yield its combined output line by line as it arrives; 
+        the generator returns the exit status. See `supr.stream`.
+        """
+        state.activity(self.id)
+        self.connection.open()
+        channel = self.connection.client.get_transport().open_session()
+        channel.set_combine_stderr(True)
+        env = ' '.join(f"{k}={shlex.quote(str(v))}" for k, v in self.vars.items())
+        channel.exec_command(f"export {env} && {cmd}" if env else cmd)
+        with channel.makefile('r') as f:
+            for line in f: yield line.rstrip('\r\n')
+        return channel.recv_exit_status()
     def ssh(self, shell='bash'):
         return self.run(f"source {self.env}/bin/activate; {shell}", pty=True)
     def put(self, local, remote):
         state.activity(self.id)
-        return self.connection.put(local, remote)
+        if os.path.getsize(local) >= CONF['BULK_THRESHOLD']:
+            from supr.transfer import bulk
+            return bulk(self, local, remote).run()
+        with span('put', f"{local} {remote}", self.name):
+            return self.connection.put(local, remote)
     def exists(self, path):
+        from patchwork.files import exists
         state.activity(self.id)
         return exists(self.connection, path)
     def rsync(self, *args, **kwargs):
+        from patchwork.transfers import rsync
         state.activity(self.id)
         #kwargs['-e'] = "ssh -o StrictHostKeyChecking=no"
-        return rsync(self.connection, *args, **kwargs)
+        kwargs['ssh_opts'] = ' '.join([self.ssh_opts, kwargs.get('ssh_opts', '')])
+        with span('rsync', ' '.join(map(str, args)), self.name):
+            return rsync(self.connection, *args, **kwargs)
     def _attach_volume(self, name):
         state.activity(self.id)
         assert name in self.conf.get('volumes', {})
         p = self.conf['volumes'][name].get('provider', 'native')
         [v(self, name) for k, v in self._storage_handlers if k == p]
     def attach_volumes(self):
+        """
+        Attach and mount every configured volume concurrently.
+        """
         state.activity(self.id)
-        [self._attach_volume(v) for v in self.conf.get('volumes', {}).keys()]
-    def mount(self, name, force=False):
+        names = list(self.conf.get('volumes', {}).keys())
+        if not names: return
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            [f.result() for f in [pool.submit(self._attach_volume, v) for v in names]]
+    def mount(self, name, force=False, dev=None):
         assert name in self.conf.get('volumes', ())
         conf = self.conf['volumes'][name]
-        assert {'dev', 'mount'}.issubset(conf)
-        dev, mount = conf['dev'], conf['mount']
+        assert 'mount' in conf and (dev or 'dev' in conf)
+        dev, mount = dev or conf['dev'], conf['mount']
         if not force and self.cmd(f"mount | grep {mount}", warn=True).ok:
             return
         self.cmd(f"sudo umount {mount}", warn=True)
         self.cmd(f"sudo mkdir -p {mount}")
         self.cmd(f"sudo chown {self.user}:{self.group} {mount}")
-        if 'options' in conf:
-            opts = " -o %s" % ','.join(conf['options'])
-        self.cmd(f"mount{opts} {dev} {mount}")
+        opts = " -o %s" % ','.join(conf['options']) if 'options' in conf else ''
+        self.cmd(f"sudo mount{opts} {dev} {mount}")
     def swap(self, name):
         assert name in self.conf.get('volumes', ())
         conf = self.conf['volumes'][name]
         assert {'path', 'size'}.issubset(conf)
-        path, size = conf['path'], conf['size']
+        path, size = conf['path'], _megabytes(conf['size'])
         if not self.exists(path):
-            self.cmd(f"sudo dd if=/dev/zero of={path} bs=1M count={size}")
+            # preallocate the blocks instead of writing every byte; not every filesystem can
+            self.cmd(f"sudo fallocate -l {size}M {path} || sudo dd if=/dev/zero of={path} bs=1M count={size}")
             self.cmd(f"sudo chmod 600 {path}")
             self.cmd(f"sudo /sbin/mkswap {path}")
         self.cmd(f"sudo /sbin/swapon {path}", warn=True)
+    def install_agent(self):
+        """
+        Utilization sampler (`supr.agent`), run every minute from the crontab.
+        """
+        self.cmd("mkdir -p .supr")
+        self.put(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'agent.py'), '.supr/agent.py')
+    # cron runs jobs from $HOME
+    agent_crontab = "* * * * * python3 .supr/agent.py"
     def install_crontab(self):
-        state.activity(self.meta.id)
-        for cmd in self.conf.get('crontab', ()):
+        state.activity(self.id)
+        crontab = list(self.conf.get('crontab', ()))
+        if self.conf.get('agent', True):
+            self.install_agent()
+            crontab.append(self.agent_crontab)
+        for cmd in crontab:
             # TODO replace updated commands
             if self.cmd("crontab -l | grep %s" % cmd.split(' ')[-1], warn=True).failed:
                 self.cmd(f"(crontab -l; echo '{cmd}') | crontab -")
@@ -248,10 +515,10 @@ class _instance:
     def _install_apt(self, name):
         self._apt_get('install', name)
     def _install_pip(self, name):
-        # TODO pyopencl builds itself every time
         # TODO --upgrade everything?
         if self.wheel_cache and self.exists(self.wheel_cache):
-            self.cmd(f"{self.pip_bin} wheel --wheel-dir={self.wheel_cache} {name}")
+            # wheels already in the cache are reused instead of rebuilt
+            self.cmd(f"{self.pip_bin} wheel --prefer-binary --find-links={self.wheel_cache} --wheel-dir={self.wheel_cache} {name}")
             self.cmd(f"{self.pip_bin} install --no-index --find-links={self.wheel_cache} {name}")
         else:
             self.cmd(f"{self.pip_bin} install --upgrade {name}")
@@ -260,9 +527,34 @@ class _instance:
         self.cmd(f"git -C {repo} pull || git clone --depth=1 https://github.com/{user}/{repo}.git {repo}")
         self.cmd(f"{self.pip_bin} install {repo}")
     def _install_local(self, name):
-        self.rsync(name, '', delete=False, exclude=CONF['LOCAL_EXCLUDE'])
-        # TODO: this could support more options
-        self.cmd(f"{self.pip_bin} install -e {name}")
+        tree, meta = _hash_tree(name, CONF['LOCAL_EXCLUDE'])
+        last = state.get_local_index(self.id, name)
+        if last and last[0] == tree:
+            print(f"{self.name}: {name} unchanged"); return
+        # already delivered by a fan-out (see `supr.fanout`)
+        if name not in getattr(self, '_relayed', ()):
+            if CONF['BULK_LOCAL']: self._bulk_local(name)
+            r = self.rsync(name, '', delete=False, exclude=CONF['LOCAL_EXCLUDE'], rsync_opts='--stats')
+            print("{}: {} {} files, {} bytes transferred".format(self.name, name, *_rsync_stats(r.stdout)))
+        # only packaging metadata changes need the package reinstalled
+        if not last or last[1] != meta:
+            # TODO: this could support more options
+            self.cmd(f"{self.pip_bin} install -e {name}")
+        state.set_local_index(self.id, name, tree, meta)
+    def _bulk_local(self, name):
+        """
+        Send large changed files in `name` with `supr.transfer` first; they
+        land with the local size and mtime, so rsync's quick check skips them.
+        """
+        from supr.transfer import large_files, bulk
+        files = large_files(name, CONF['LOCAL_EXCLUDE'], CONF['BULK_THRESHOLD'])
+        if not files: return
+        paths = ' '.join(shlex.quote(p) for p in files)
+        r = self.cmd(f"stat -c '%s %Y %n' {paths} 2>/dev/null", hide=True, warn=True)
+        remote = {n: (int(size), int(mtime)) for size, mtime, n in
+            (line.split(' ', 2) for line in r.stdout.splitlines() if line.count(' ') >= 2)}
+        for p, (size, mtime) in files.items():
+            if remote.get(p) != (size, mtime): bulk(self, p, p).run()
     def install(self, source, name):
         match source, name:
             case ['apt', name]: self._install_apt(name)
@@ -270,6 +562,49 @@ class _instance:
             case ['github', name]: self._install_github(name)
             case ['local', name]: self._install_local(name)
             case _: assert False, f"invalid package source {source}"
+    # sources whose consecutive specs can share a single transaction
+    _batched_sources = ('apt', 'pip')
+    # sources that track moving targets and are always reinstalled
+    _unmanifested_sources = ('github', 'local')
+    manifest_path = property(lambda self: self.env/'supr-manifest.json')
+    def _read_manifest(self) -> dict:
+        r = self.cmd(f"cat {self.manifest_path}", hide=True, warn=True)
+        try: return json.loads(r.stdout) if r.ok else {}
+        except ValueError: return {}
+    def _write_manifest(self, specs):
+        specs = sorted(set(specs))
+        manifest = dict(specs=specs, hash=_hash_specs(specs))
+        self.cmd(f"echo {shlex.quote(json.dumps(manifest))} > {self.manifest_path}", hide=True)
+    def install_many(self, specs, force=False):
+        """
+        Install `source:name` specs in the order listed, with one `apt-get`/`pip`
+        transaction per run of consecutive specs from the same source. Specs
+        already recorded in the host's manifest are skipped unless `force`.
+        """
+        specs = [s.split(':', 1) for s in specs]
+        for source, name in specs:
+            assert source in self._batched_sources + self._unmanifested_sources, \
+                f"invalid package source {source}"
+        if force: state.clear_local_index(self.id)
+        manifest = self._read_manifest()
+        installed = set(manifest.get('specs', ()))
+        # a manifest that doesn't match its hash can't be trusted
+        if manifest.get('hash') != _hash_specs(installed): installed = set()
+        # other stages share the manifest; forcing only forgets these specs
+        if force: installed -= {f"{s}:{n}" for s, n in specs}
+        cache = self.artifact_cache if any(s in self._batched_sources and f"{s}:{n}" not in installed
+            for s, n in specs) else None
+        if cache: cache.pull()
+        for source, run in groupby(specs, key=lambda s: s[0]):
+            names = [n for _, n in run]
+            if source in self._unmanifested_sources:
+                [self.install(source, n) for n in names]; continue
+            names = [n for n in dict.fromkeys(names) if f"{source}:{n}" not in installed]
+            if not names: continue
+            self.install(source, ' '.join(names))
+            installed |= set(f"{source}:{n}" for n in names)
+            self._write_manifest(installed)
+        if cache: cache.push()
     def install_essential(self):
         self._add_apt_sources()
         self.cmd("sudo apt-get update")
@@ -277,20 +612,24 @@ class _instance:
         if not self.exists(self.env):
             self.cmd(f"python3 -m venv {self.env}")
         self._install_pip(' '.join(CONF['PIP_ESSENTIAL']))
-    def install_base(self):
+    def install_base(self, force=False):
         state.activity(self.id)
-        for s_n in self.conf.get('packages', {}).get('base', ()):
-            self.install(*s_n.split(':'))
-    def deploy(self):
+        self.install_many(self.conf.get('packages', {}).get('base', ()), force)
+    @traced('deploy')
+    def deploy(self, force=False):
         state.activity(self.id)
-        for s_n in self.conf.get('packages', {}).get('app', ()):
-            self.install(*s_n.split(':'))
-    def hook(self, cmd, *args):
+        self.install_many(self.conf.get('packages', {}).get('app', ()), force)
+    def hook_command(self, cmd, *args):
         cmds = self.conf.get('hooks', {})
+        return f"{cmds[cmd]} {' '.join(args)}"
+    def prepare_hook(self):
         self.start()
         self.attach_volumes()
         self.deploy()
-        self.ssh(f"{cmds[cmd]} {' '.join(args)}")
+    @traced('hook')
+    def hook(self, cmd, *args):
+        self.prepare_hook()
+        self.ssh(self.hook_command(cmd, *args))
 
 class baseinstance(_instance, _abstractinstance): pass
 
@@ -298,14 +637,74 @@ class _abstractbackend(metaclass=abc.ABCMeta):
     """
     Methods that must be provided on backend implementatons.
     """
-    def create_instance(self, name): pass
+    def create_instance(self, name, baked=True): pass
     def get_instance_by_id(self, _id): pass
     def get_instances(self, *filters): pass
+    def describe_many(self, ids): pass
+    def start_many(self, instances): pass
+    def stop_many(self, instances): pass
+    def terminate_many(self, instances): pass
 
 class _backend:
     """
     Shared logic for backend implementations.
     """
+    def invalidate(self):
+        """
+        Drop any cached inventory; called after lifecycle changes.
+        """
+        pass
+    # EC2 caps the number of values in a single filter
+    filter_chunk = 200
+    def get_instances_by_id(self, ids, *filters) -> list[_instance]:
+        ids = list(ids)
+        return [i for n in range(0, len(ids), self.filter_chunk)
+            for i in self.get_instances(F_ID[ids[n:n + self.filter_chunk]], *filters)]
+    def describe_many(self, ids) -> list[_instance]:
+        """
+        Fresh instances for `ids`, with as few requests as the backend allows.
+        """
+        return self.get_instances_by_id(ids, F_STATE['*'])
+    # implementations override these to act on many instances per request
+    def _start_many(self, instances):
+        [i._start() for i in instances]
+    def _stop_many(self, instances):
+        [i._stop() for i in instances]
+    def _terminate_many(self, instances):
+        [i._terminate() for i in instances]
+    def _wait_many(self, instances, state):
+        [getattr(i, f"wait_until_{state}")() for i in instances]
+    def start_many(self, instances):
+        """
+        Start instances together and wait for all of them at once.
+        """
+        if not instances: return
+        with timed(f"{len(instances)} instances", 'start'):
+            self._start_many(instances)
+            [state.change(i.id, 'start', i.name, i.conf.get('hour_cost')) for i in instances]
+            self.invalidate()
+            self._wait_many(instances, 'running')
+    def stop_many(self, instances):
+        """
+        Stop instances together and wait for all of them at once.
+        """
+        if not instances: return
+        with timed(f"{len(instances)} instances", 'stop'):
+            self._stop_many(instances)
+            self.invalidate()
+            self._wait_many(instances, 'stopped')
+        [state.change(i.id, 'stop') for i in instances]
+    def terminate_many(self, instances):
+        """
+        Terminate instances together, except supervisors, and wait for all of them.
+        """
+        instances = [i for i in instances if not i.is_super]
+        if not instances: return
+        with timed(f"{len(instances)} instances", 'terminate'):
+            self._terminate_many(instances)
+            self.invalidate()
+            self._wait_many(instances, 'terminated')
+        [state.change(i.id, 'stop') for i in instances]
     def get_instance(self, name, *filters) -> _instance:
         i = self.get_instances(*list(filters) + [F_NAME[name]])
         if len(i) < 1: print("no instances with name %s" % name); return None
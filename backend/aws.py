@@ -1,6 +1,12 @@
-import boto3
-from supr import DEBUG, CONF
-from supr.backend import baseinstance, basebackend
+import os
+import json
+import time
+import threading
+from fnmatch import fnmatch
+from supr import DEBUG, CONF, INVENTORY_PATH, log
+from supr.backend import baseinstance, basebackend, F_ID, _dump_json
+from supr.ready import backoff, timed
+from supr import spans
 
 
 class instance(baseinstance):
@@ -16,13 +22,31 @@ class instance(baseinstance):
     def _start(self): return self.meta.start()
     def _stop(self): return self.meta.stop()
     def _terminate(self): return self.meta.terminate()
-    def wait_until_running(self): self.meta.wait_until_running()
-    def wait_until_stopped(self): self.meta.wait_until_stopped()
-    def wait_until_terminated(self): self.meta.wait_until_terminated()
+    def _refresh(self): self.meta.reload()
+    def wait_until_running(self): self.wait_for_state('running')
+    def wait_until_stopped(self): self.wait_for_state('stopped')
+    def wait_until_terminated(self): self.wait_for_state('terminated')
+    def _rename(self, name):
+        self.meta.create_tags(Tags=[dict(Key='Name', Value=name)])
+        self.meta.reload()
+    _storage_handlers = baseinstance._storage_handlers + [
+        ('aws:s3', lambda self, name: self._attach_bucket(name)), 
+        ('aws:ebs', lambda self, name: self._attach_storage(name)), 
+    ]
+    # device names EC2 recommends for attaching EBS volumes
+    _devices = tuple(f"/dev/sd{c}" for c in 'fghijklmnop')
+    _devices_lock = threading.Lock()
     def __init__(self, meta):
         self.meta = meta
-        self._storage_handlers.append(('aws:s3', lambda self, name: self._attach_bucket(name)))
-        self._storage_handlers.append(('aws:ebs',lambda self, name: self._attach_storage(name)))       
+        self._reserved = set()
+    def _allocate_device(self) -> str:
+        with self._devices_lock:
+            used = {m['DeviceName'] for m in self.meta.block_device_mappings} | self._reserved
+            dev = next((d for d in self._devices if d not in used 
+                and d.replace('/sd', '/xvd') not in used), None)
+            assert dev, f"no free device names on {self.name}"
+            self._reserved.add(dev)
+            return dev
     def _attach_bucket(self, name):
         assert name in self.conf.get('volumes', ())
         conf, passwd = self.conf['volumes'][name], self.home/'.aws/passwd'
@@ -39,17 +63,44 @@ class instance(baseinstance):
         conf = self.conf['volumes'][name]
         assert conf.get('provider') == 'aws:ebs'
         if not 'id' in conf: return
-        if conf['id'] in [v.volume_id for v in self.meta.volumes.all()]: return # already attached
-        # TODO get next available dev name; this doesn't even show up in the instance this way
-        self.meta.attach_volume(
-            Device="/dev/sdg", #conf_v['dev'], 
-            VolumeId=conf['id'])
-        self.meta.wait_until_running()
-        self.mount(name)
-    def _snapshot(self, name) -> str:
+        device = next((m['DeviceName'] for m in self.meta.block_device_mappings 
+            if m.get('Ebs', {}).get('VolumeId') == conf['id']), None)
+        if not device: # not attached yet
+            device = self._allocate_device()
+            self.meta.attach_volume(Device=device, VolumeId=conf['id'])
+        with timed(self.name, f"attach {name}"):
+            # the kernel may name it something else entirely
+            dev = self.wait_until_attached(conf['id'], device)
+        self.mount(name, dev=dev)
+    def wait_until_attached(self, volume_id, device) -> str:
+        """
+        Wait for EC2 to report the volume attached and for its block device 
+        to show up on the host (xen renames sdX to xvdX, nvme instances 
+        number them; find those by serial). Returns the device path.
+        """
+        client = self.meta.meta.client
+        def attached():
+            v = client.describe_volumes(VolumeIds=[volume_id])['Volumes'][0]
+            return any(a['State'] == 'attached' and a['InstanceId'] == self.id for a in v['Attachments'])
+        backoff(attached, what=f"{volume_id} attached to {self.name}")
+        def device():
+            candidates = f"/dev/disk/by-id/*{volume_id.replace('-', '')}* {device} {device.replace('/sd', '/xvd')}"
+            r = self.cmd(f'for d in {candidates}; do [ -b "$d" ] && readlink -f "$d" && break; done', 
+                warn=True, hide=True)
+            return r.stdout.strip() if r.ok else None
+        return backoff(device, what=f"{volume_id} device on {self.name}")
+    def _tag(self, key):
+        return next((t['Value'] for t in self.meta.tags or [] if t['Key'] == key), None)
+    def _snapshot(self, name, tags=None) -> str:
         self.wait_until_running()
-        ami = self.meta.create_image(Name=name)
-        self.client.get_waiter('image_available').wait(ImageIds=[ami.id])
+        kwargs = dict(TagSpecifications=[dict(ResourceType='image', 
+            Tags=[dict(Key=k, Value=v) for k, v in tags.items()])]) if tags else {}
+        ami = self.meta.create_image(Name=name, **kwargs)
+        def available():
+            ami.reload()
+            assert ami.state != 'failed', f"image {ami.id} failed"
+            return ami.state == 'available'
+        backoff(available, timeout=3600, cap=30, what=f"image {ami.id}")
         return ami.id
 
 class backend(basebackend):
@@ -58,27 +109,138 @@ class backend(basebackend):
         if not hasattr(self, '_client'):
             c = CONF['base']['aws']
             assert {'key', 'secret', 'region'}.issubset(c)
+            import boto3
+            from botocore.config import Config
             self._session = boto3.Session(c['key'], c['secret'], region_name=c['region'])
-            self._client = self._session.resource('ec2')
+            # client side rate limiting keeps large fleets under the API limits
+            self._client = self._session.resource('ec2', config=Config(retries=dict(mode='adaptive', max_attempts=10)))
+            events = self._client.meta.client.meta.events
+            events.register('before-call.ec2', spans.before_call)
+            events.register('after-call.ec2', spans.after_call)
         return self._client
+    # StartInstances/StopInstances/TerminateInstances accept this many ids
+    batch_size = 1000
+    # error codes EC2 uses when we're over the API rate limit
+    throttle_codes = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+    def _batches(self, instances):
+        ids = [getattr(i, 'id', i) for i in instances]
+        return [ids[n:n + self.batch_size] for n in range(0, len(ids), self.batch_size)]
+    def _call(self, operation, **kwargs):
+        """
+        Call an EC2 client `operation`, backing off for as long as it's throttled.
+        """
+        from botocore.exceptions import ClientError
+        def attempt():
+            try: return (getattr(self.client.meta.client, operation)(**kwargs), )
+            except ClientError as e:
+                if e.response['Error']['Code'] not in self.throttle_codes: raise
+                log.warning(f"[supr.aws] {operation} throttled")
+        return backoff(attempt, timeout=300, base=1, cap=20, what=f"{operation} throttling")[0]
+    def _start_many(self, instances):
+        [self._call('start_instances', InstanceIds=ids) for ids in self._batches(instances)]
+    def _stop_many(self, instances):
+        [self._call('stop_instances', InstanceIds=ids) for ids in self._batches(instances)]
+    def _terminate_many(self, instances):
+        [self._call('terminate_instances', InstanceIds=ids) for ids in self._batches(instances)]
+    def _describe_many(self, ids) -> list[dict]:
+        # filtering on ids pages results and tolerates ids that no longer exist
+        return [d for n in range(0, len(ids), self.filter_chunk)
+            for page in self.client.meta.client.get_paginator('describe_instances').paginate(
+                Filters=[F_ID[ids[n:n + self.filter_chunk]]])
+            for r in page['Reservations'] for d in r['Instances']]
+    def describe_many(self, ids) -> list[instance]:
+        return [self._from_inventory(d) for d in self._describe_many(list(ids))]
+    def _wait_many(self, instances, state):
+        by_id = {i.id: i for i in instances}
+        def settled():
+            data = self._describe_many(list(by_id))
+            for d in data: by_id[d['InstanceId']].meta.meta.data = d
+            assert state == 'terminated' or not any(d['State']['Name'] == 'terminated' for d in data), \
+                "instances were terminated"
+            return all(d['State']['Name'] == state for d in data)
+        backoff(settled, what=f"{len(instances)} instances {state}")
+    _inventory = None
+    _inventory_lock = threading.Lock()
+    # filters the inventory snapshot can answer without asking EC2
+    _inventory_filters = {
+        'instance-id': lambda d: [d['InstanceId']], 
+        'instance-state-name': lambda d: [d['State']['Name']], 
+    }
+    def _describe_all(self) -> list[dict]:
+        paginator = self.client.meta.client.get_paginator('describe_instances')
+        return [d for page in paginator.paginate()
+            for r in page['Reservations'] for d in r['Instances']]
+    @property
+    def inventory(self) -> list[dict]:
+        """
+        Describe data for every instance, from memory, then `INVENTORY_PATH`, 
+        then one paginated describe, whichever is newer than `INVENTORY_TTL`.
+        """
+        fresh = lambda t: time.time() - t < CONF['INVENTORY_TTL']
+        with self._inventory_lock:
+            if self._inventory and fresh(self._inventory[0]):
+                return self._inventory[1]
+            try:
+                with open(INVENTORY_PATH) as f: t, data = json.load(f)
+                if fresh(t): self._inventory = (t, data); return data
+            except (OSError, ValueError): pass
+            t, data = time.time(), json.loads(json.dumps(self._describe_all(), default=str))
+            _dump_json([t, data], INVENTORY_PATH)
+            self._inventory = (t, data)
+            return data
+    def invalidate(self):
+        with self._inventory_lock:
+            self._inventory = None
+            try: os.unlink(INVENTORY_PATH)
+            except FileNotFoundError: pass
+    def _from_inventory(self, data) -> instance:
+        from supr import instance
+        r = self.client.Instance(data['InstanceId'])
+        r.meta.data = data
+        return instance(r)
+    def _match(self, data, f) -> bool:
+        if f['Name'].startswith('tag:'):
+            values = [t['Value'] for t in data.get('Tags', []) if t['Key'] == f['Name'][4:]]
+        else:
+            values = self._inventory_filters[f['Name']](data)
+        return any(fnmatch(v, p) for v in values for p in f['Values'])
     def get_instance_by_id(self, _id) -> instance:
         from supr import instance
-        return instance(self.client.Instance(_id))
+        i = self.get_instances(F_ID[_id]) if CONF['INVENTORY_TTL'] else None
+        return i[0] if i else instance(self.client.Instance(_id))
     def get_instances(self, *filters) -> list[instance]:
         from supr import instance
+        if CONF['INVENTORY_TTL'] and all(
+                f['Name'] in self._inventory_filters or f['Name'].startswith('tag:') for f in filters):
+            return [self._from_inventory(d) for d in self.inventory if all(self._match(d, f) for f in filters)]
+        log.debug(f"[supr.aws] inventory can't answer {filters}")
         return [instance(r) for r in self.client.instances.filter(Filters=filters)]
-    def create_instance(self, name) -> instance:
+    def find_image(self, image_hash) -> str:
+        """
+        Newest available image baked with `image_hash`, if any.
+        """
+        images = self.client.meta.client.describe_images(Owners=['self'], Filters=[
+            dict(Name='tag:supr:image-hash', Values=[image_hash]), 
+            dict(Name='state', Values=['available'])])['Images']
+        return max(images, key=lambda i: i['CreationDate'])['ImageId'] if images else None
+    def create_instance(self, name, baked=True) -> instance:
         from supr import instance
         conf = instance.get_conf(name)
         assert 'aws:type' in conf
         i = dict(
             InstanceType=conf['aws:type'],
             MaxCount=1, MinCount=1)
+        tags = [dict(Key='Name', Value=name)]
         if 'aws:ami' in conf:
             assert {'key_pair', 'aws:security_groups', 'aws:subnet'}.issubset(conf)
             assert 'aws:name' in conf['key_pair']
+            image_hash = instance.image_hash(name)
+            image = self.find_image(image_hash) if baked else None
+            if image:
+                log.info(f"[supr.aws] launching {name} from baked image {image}")
+                tags.append(dict(Key='supr:image-hash', Value=image_hash))
             i.update(dict(
-                ImageId=conf['aws:ami'], 
+                ImageId=image or conf['aws:ami'], 
                 KeyName=conf['key_pair']['aws:name'], 
                 SecurityGroupIds=conf['aws:security_groups'], 
                 SubnetId=conf['aws:subnet']))
@@ -102,6 +264,7 @@ class backend(basebackend):
             i['BlockDeviceMappings'].append(b)
         if DEBUG: print(i); input('create?')
         r = self.client.create_instances(**i)[0]
-        r.create_tags(Tags=[dict(Key='Name', Value=name)])
+        r.create_tags(Tags=tags)
+        self.invalidate()
         return instance(r)
 
@@ -0,0 +1,174 @@
+import io
+import re
+import time
+import zlib
+import shlex
+import hashlib
+import random
+import threading
+from fnmatch import fnmatch
+from supr import CONF
+from supr.backend import baseinstance, basebackend
+
+
+class result:
+    """
+    The parts of `invoke.Result` supr looks at.
+    """
+    def __init__(self, command, stdout='', exited=0):
+        self.command, self.stdout, self.stderr, self.exited = command, stdout, '', exited
+    ok = property(lambda self: self.exited == 0)
+    failed = property(lambda self: not self.ok)
+    return_code = property(lambda self: self.exited)
+
+class channel:
+    """
+    The exec channel `supr.transfer` streams chunks into. Its stdout is bytes,
+    as it is from paramiko.
+    """
+    CHUNK = re.compile(r"(gzip -dc|zstd -dcq|cat) \| dd of=(\S+) seek=(\d+) .* head -c (\d+) \| sha256sum$")
+    def __init__(self, connection):
+        self.connection, self.data, self.out, self.status = connection, bytearray(), b'', None
+    def exec_command(self, cmd): self.cmd = cmd
+    def sendall(self, data): self.data += data
+    def shutdown_write(self):
+        time.sleep(self.connection.latency)
+        m = self.CHUNK.match(self.cmd)
+        assert m, f"unexpected command {self.cmd}"
+        codec, path, offset, length = m[1], shlex.split(m[2])[0], int(m[3]), int(m[4])
+        match codec:
+            case 'gzip -dc': data = zlib.decompress(bytes(self.data), 31)
+            case 'zstd -dcq':
+                import zstandard
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(bytes(self.data))
+            case _: data = bytes(self.data)
+        with self.connection.lock:
+            f = self.connection.files.setdefault(path, bytearray())
+            f.extend(bytes(max(0, offset + len(data) - len(f))))
+            f[offset:offset + len(data)] = data
+            digest = hashlib.sha256(f[offset:offset + length]).hexdigest()
+        self.out, self.status = f"{digest}  -\n".encode(), 0
+    def makefile(self, mode): return io.BytesIO(self.out)
+    def recv_exit_status(self): return self.status
+
+class connection:
+    """
+    Stands in for an SSH server: every command costs `latency` seconds and
+    succeeds, except for the few probes supr makes, which are answered from
+    an in-memory filesystem. `&&` chains stop at the first failure.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.files = {}
+        self.commands = []
+        self.lock = threading.Lock()
+    def open(self): pass
+    def close(self): pass
+    # paramiko's `client.get_transport().open_session()`
+    client = property(lambda self: self)
+    def get_transport(self): return self
+    def open_session(self): return channel(self)
+    def local(self, cmd, **kwargs): return result(cmd)
+    def _run(self, cmd):
+        try: argv = shlex.split(cmd)
+        except ValueError: argv = cmd.split()
+        with self.lock:
+            match argv:
+                case ['test', '-e', path]: return result(cmd, exited=0 if path in self.files else 1)
+                case ['cat', path]: return result(cmd, str(self.files.get(path, '')), 0 if path in self.files else 1)
+                case ['echo', *words, '>', path]: self.files[path] = ' '.join(words) + '\n'
+                case ['echo', *words, '>>', path]: self.files[path] = self.files.get(path, '') + ' '.join(words) + '\n'
+                case ['rm', '-f', *paths]: [self.files.pop(path, None) for path in paths]
+                case ['mv', src, dst]:
+                    if src not in self.files: return result(cmd, exited=1)
+                    self.files[dst] = self.files.pop(src)
+                case ['python3', '-m', 'venv', path]: self.files[path] = ''
+        return result(cmd)
+    def run(self, cmd, env=None, hide=False, warn=False, pty=False, **kwargs):
+        time.sleep(self.latency)
+        self.commands.append(cmd)
+        for part in cmd.split(' && '):
+            r = self._run(part)
+            if r.failed: break
+        r.command = cmd
+        assert r.ok or warn, f"{cmd} exited {r.exited}"
+        return r
+    def put(self, local, remote):
+        time.sleep(self.latency)
+        self.files[remote] = ''
+
+class instance(baseinstance):
+    """
+    In-process instance with simulated boot latency; see `backend`.
+    """
+    id = property(lambda self: self._id)
+    name = property(lambda self: self._tags.get('Name', 'none'))
+    tags = property(lambda self: [v for k, v in self._tags.items() if k != 'Name'])
+    public_ip_address = property(lambda self: self._ip)
+    private_ip_address = property(lambda self: self._ip)
+    instance_type = property(lambda self: self.conf.get('aws:type', 'fake'))
+    connection = property(lambda self: self._connection)
+    _connect = lambda self: self._connection
+    def __init__(self, _id, name, ip):
+        self._id, self._ip = _id, ip
+        self._tags = dict(Name=name)
+        self._state, self._until = 'pending', time.time() + CONF['fake'].get('boot', 0.05)
+        self._connection = connection(CONF['fake'].get('latency', 0.001))
+    @property
+    def state(self):
+        # transitions complete on their own once their latency has passed
+        if self._until and time.time() >= self._until:
+            self._state = dict(pending='running', stopping='stopped',
+                **{'shutting-down': 'terminated'}).get(self._state, self._state)
+            self._until = None
+        return self._state
+    def _transition(self, state, latency):
+        self._state, self._until = state, time.time() + latency
+    def _start(self): self._transition('pending', CONF['fake'].get('boot', 0.05))
+    def _stop(self): self._transition('stopping', CONF['fake'].get('halt', 0.01))
+    def _terminate(self): self._transition('shutting-down', CONF['fake'].get('halt', 0.01))
+    def _wait(self, state):
+        if self._until: time.sleep(max(0, self._until - time.time()))
+        assert self.state == state, f"{self.name} is {self.state}, not {state}"
+    def wait_until_running(self): self._wait('running')
+    def wait_until_stopped(self): self._wait('stopped')
+    def wait_until_terminated(self): self._wait('terminated')
+    def wait_until_connectable(self): pass
+    def _rename(self, name): self._tags['Name'] = name
+    def _tag(self, key): return self._tags.get(key)
+    def _snapshot(self, name, tags=None): return f"ami-{random.getrandbits(32):08x}"
+    def exists(self, path): return self.run(f"test -e {path}", warn=True).ok
+    def rsync(self, *args, **kwargs):
+        self.connection.run(f"rsync {' '.join(map(str, args))}")
+        return result('rsync', stdout="Number of regular files transferred: 0\nTotal bytes sent: 0\n")
+    def stream(self, cmd):
+        yield self.run(cmd, hide=True).stdout
+        return 0
+
+class backend(basebackend):
+    """
+    Fully in-process backend for benchmarks and offline use; configure with
+    `fake: {boot: seconds, halt: seconds, latency: seconds per command}`.
+    """
+    _fields = {
+        'instance-id': lambda i: [i.id],
+        'instance-state-name': lambda i: [i.state],
+    }
+    def __init__(self):
+        self.instances = {}
+        self.lock = threading.Lock()
+    def _match(self, i, f) -> bool:
+        if f['Name'].startswith('tag:'): values = [i._tag(f['Name'][4:])]
+        else: values = self._fields[f['Name']](i)
+        return any(v is not None and fnmatch(v, p) for v in values for p in f['Values'])
+    def get_instance_by_id(self, _id) -> instance:
+        return self.instances.get(_id)
+    def get_instances(self, *filters) -> list[instance]:
+        with self.lock: instances = list(self.instances.values())
+        return [i for i in instances if all(self._match(i, f) for f in filters)]
+    def create_instance(self, name, baked=True) -> instance:
+        with self.lock:
+            n = len(self.instances)
+            i = instance(f"i-{n:017x}", name, f"127.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}")
+            self.instances[i.id] = i
+        return i
@@ -1,25 +1,106 @@
+import os
+import json
+import time
 import socket
-import supr
-from supr.backend import baseinstance, basebackend
+import threading
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from supr import CONF, INVENTORY_PATH, log
+from supr.backend import baseinstance, basebackend, _dump_json
+from supr.ready import backoff, port_open
+
 
 class instance(baseinstance):
-    private_ip_address = lambda self: self.public_ip_address
-    def __init__(self, name):
-        self.state = 'running'
-        self.id = name
-        self.name = name
-        self.public_ip_address = socket.gethostbyname(name)
-    def start(self): raise NotImplementedError()
-    def stop(self): raise NotImplementedError()
-    def terminate(self): raise NotImplementedError()
-    def _snapshot(self): raise NotImplementedError()
-    def _attach_volume(self, volume): raise NotImplementedError()
+    """
+    A host listed under `local:`. It's always on as far as supr can tell, so
+    `state` is `running` when sshd answers, `stopped` when it doesn't and
+    `unknown` when the name doesn't resolve.
+    """
+    id = property(lambda self: self._name)
+    name = property(lambda self: self._name)
+    state = property(lambda self: self._state)
+    tags = property(lambda self: [])
+    public_ip_address = property(lambda self: self._ip)
+    private_ip_address = property(lambda self: self._ip)
+    instance_type = property(lambda self: 'local')
+    def __init__(self, name, ip=None, state='unknown'):
+        self._name, self._ip, self._state = name, ip, state
+    def _refresh(self):
+        from supr import backend
+        self._ip, self._state = backend.probe(self.name)
+    # there's no power switch; starting waits for the host and stopping just stops billing
+    def _start(self): pass
+    def _stop(self): pass
+    def _terminate(self): raise NotImplementedError()
+    def _snapshot(self, name, tags=None): raise NotImplementedError()
+    def wait_until_running(self): self.wait_for_state('running')
+    def wait_until_stopped(self): pass
+    def wait_until_terminated(self): pass
 
 class backend(basebackend):
+    """
+    Resolves and probes hosts concurrently, caching results in
+    `INVENTORY_PATH` for `INVENTORY_TTL` seconds.
+    """
+    _inventory = None
+    def __init__(self):
+        self.lock = threading.Lock()
+    @staticmethod
+    def probe(name) -> tuple[str, str]:
+        try: ip = socket.gethostbyname(name)
+        except OSError: return None, 'unknown'
+        return ip, 'running' if port_open(ip) else 'stopped'
+    def _probe_many(self, names) -> dict:
+        if not names: return {}
+        with ThreadPoolExecutor(max_workers=min(64, len(names))) as pool:
+            return dict(zip(names, pool.map(self.probe, names)))
+    def _load(self) -> dict:
+        if self._inventory is None:
+            try:
+                with open(INVENTORY_PATH) as f: self._inventory = json.load(f)
+            except (OSError, ValueError): self._inventory = {}
+        return self._inventory
+    def _resolve(self, names) -> list[instance]:
+        """
+        Instances for `names`, probing only those not seen within `INVENTORY_TTL`.
+        """
+        with self.lock:
+            cache, now = self._load(), time.time()
+            stale = [n for n in names if now - cache.get(n, (0, ))[0] >= CONF['INVENTORY_TTL']]
+            if stale:
+                cache.update({n: (now, *r) for n, r in self._probe_many(stale).items()})
+                _dump_json(cache, INVENTORY_PATH)
+            return [instance(n, *cache[n][1:]) for n in names]
+    def invalidate(self):
+        with self.lock:
+            self._inventory = None
+            try: os.unlink(INVENTORY_PATH)
+            except FileNotFoundError: pass
+    @staticmethod
+    def _match(value, f) -> bool:
+        return any(fnmatch(value, p) for p in f['Values'])
     def get_instance_by_id(self, _id) -> instance:
-        return supr.instance(_id)
+        return next(iter(self._resolve([_id])), None)
     def get_instances(self, *filters) -> list[instance]:
-        return [supr.instance(name) for name in supr.CONF['local']]
-    def create_instance(self, name) -> instance:
-        raise NotImplementedError()
-
+        names = list(CONF['local'])
+        # names and ids are the same thing here and cost nothing to match
+        for f in filters:
+            if f['Name'] in ('tag:Name', 'instance-id'):
+                names = [n for n in names if self._match(n, f)]
+            elif f['Name'].startswith('tag:'): return []
+        instances = self._resolve(names)
+        for f in filters:
+            if f['Name'] == 'instance-state-name':
+                instances = [i for i in instances if self._match(i.state, f)]
+        return instances
+    def describe_many(self, ids) -> list[instance]:
+        return [instance(n, *r) for n, r in self._probe_many(list(ids)).items()]
+    def _wait_many(self, instances, state):
+        if state != 'running': return
+        def reachable():
+            down = [n for n, (_, s) in self._probe_many([i.name for i in instances]).items() if s != 'running']
+            if down: log.debug(f"[supr.local] waiting for {' '.join(down)}")
+            return not down
+        backoff(reachable, what=f"{len(instances)} hosts reachable")
+    def create_instance(self, name, baked=True) -> instance:
+        raise NotImplementedError("local hosts can't be created; add them to `local:`")
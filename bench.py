@@ -0,0 +1,136 @@
+"""
+Offline benchmarks for the control plane, run against the fake backend so
+they need no credentials or network:
+
+    python supr/bench.py [--sizes 1,10,100,1000] [--save bench.json]
+                         [--baseline bench.json] [--tolerance 0.25]
+
+Exits non-zero if any measurement is slower than `--baseline` by more than
+`--tolerance`. Run as a script; importing `supr` requires a config, which
+is written to a temporary directory before the package is loaded.
+"""
+import os
+import io
+import sys
+import json
+import shutil
+import atexit
+import time
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+PREFIX = 'bench'
+# measurements below this many seconds are too noisy to call a regression
+NOISE = 0.02
+# size of the file sent over `supr.transfer`
+BULK_BYTES = 4 * 1024 * 1024
+
+
+def configure(tmp, sizes, boot, latency):
+    names = {f"{PREFIX}{n}": dict(
+        user='bench', env='/opt/bench', key_pair=dict(file='/dev/null'), hour_cost=0.1,
+        packages=dict(base=['apt:htop', 'pip:numpy'], app=['pip:requests']),
+    ) for n in range(max(sizes))}
+    conf = dict(IDLE_TIMEOUT=60, FLEET_WORKERS=32, fake=dict(boot=boot, halt=boot / 5, latency=latency),
+        BULK_THRESHOLD=BULK_BYTES // 4, BULK_CHUNK=BULK_BYTES // 8, BULK_COMPRESS='gzip', **names)
+    with open(os.path.join(tmp, 'supr.yaml'), 'w') as f: json.dump(conf, f)  # JSON is YAML
+    for k, v in dict(CONF='supr.yaml', DB='.supr.db', LOG='.supr.log', POOL='.supr.pool',
+            INVENTORY='.supr.inventory', CONF_CACHE='.supr.conf').items():
+        os.environ[f"SUPR_{k}"] = os.path.join(tmp, v)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def measure(fn):
+    t = time.perf_counter()
+    with redirect_stdout(io.StringIO()): fn()
+    return time.perf_counter() - t
+
+def assert_stopped(idle, n):
+    assert len(idle) == n, f"sweep stopped {len(idle)} of {n}"
+
+def bulk():
+    """
+    One `put` over `supr.transfer`, checked against what lands on the host.
+    """
+    from supr import instance
+    i = instance.new(f"{PREFIX}0")
+    i.wait_until_running()
+    with tempfile.NamedTemporaryFile() as f:
+        # half random, half repeated, so compression has something to do
+        data = os.urandom(BULK_BYTES // 2) * 2
+        f.write(data); f.flush()
+        i.put(f.name, 'bulk')
+    assert i.connection.files.get('bulk') == data, "bulk transfer doesn't match"
+
+def run(sizes) -> dict:
+    from supr import backend, instance, state
+    from supr.backend import F_ACTIVE
+    from supr.fleet import fleet
+    from supr import cron
+    results = dict(bulk=measure(bulk))
+    for n in sizes:
+        names = [f"{PREFIX}{k}" for k in range(n)]
+        # start each size from an empty fleet
+        backend.instances.clear()
+        def create():
+            def one(name):
+                i = instance.new(name)
+                i.init()
+            with ThreadPoolExecutor(max_workers=32) as pool:
+                [f.result() for f in [pool.submit(one, name) for name in names]]
+        results[f"create/{n}"] = measure(create)
+        results[f"list/{n}"] = measure(lambda: [print(i) for i in backend.get_instances(F_ACTIVE)])
+        def deploy():
+            failed = [(i.name, e) for i, ok, e, _ in fleet.select(f"{PREFIX}*").call('deploy') if not ok]
+            assert not failed, f"deploy failed: {failed[:3]}"
+        results[f"deploy/{n}"] = measure(deploy)
+        ids = [i.id for i in backend.get_instances(F_ACTIVE)]
+        def writes():
+            for _id in ids: state.change(_id, 'stop')
+            for _id in ids: state.change(_id, 'start', _id, 0.1)
+        results[f"state/{n}"] = measure(writes)
+        # everything looks idle to the sweep, which stops the whole fleet
+        state.recorder.flush()
+        state._write("UPDATE instance_activity SET last_interacted=datetime('now', '-1 day')")
+        results[f"sweep/{n}"] = measure(lambda: assert_stopped(cron.sweep(), n))
+        for i in backend.get_instances(F_ACTIVE):
+            i._terminate()
+    return results
+
+def compare(results, baseline, tolerance) -> list:
+    regressions = []
+    for k, t in results.items():
+        if k not in baseline: continue
+        if t > baseline[k] * (1 + tolerance) and t - baseline[k] > NOISE:
+            regressions.append((k, baseline[k], t))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1,10,100,1000')
+    parser.add_argument('--boot', type=float, default=0.01, help="simulated seconds to boot an instance")
+    parser.add_argument('--latency', type=float, default=0.0005, help="simulated seconds per remote command")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--save', help="write results as JSON")
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(',')]
+
+    tmp = tempfile.mkdtemp(prefix='supr-bench-')
+    # registered first so it runs after supr's own exit handlers flush the state DB
+    atexit.register(shutil.rmtree, tmp, True)
+    configure(tmp, sizes, args.boot, args.latency)
+    results = run(sizes)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+    for k, t in results.items():
+        base = f"{baseline[k]:>9.3f}s" if k in baseline else ''
+        print(f"{k:<16} {t:>9.3f}s {base}")
+    if args.save:
+        with open(args.save, 'w') as f: json.dump(results, f, indent=2)
+    regressions = compare(results, baseline, args.tolerance)
+    for k, before, after in regressions:
+        print(f"regression: {k} {before:.3f}s -> {after:.3f}s")
+    sys.exit(1 if regressions else 0)
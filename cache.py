@@ -0,0 +1,115 @@
+import os
+import time
+from pathlib import Path as path
+from supr import log
+from supr.spans import span
+from supr.backend import _megabytes
+
+
+# where a host keeps its copy of the cache; `apt_cache` and `wheel_cache` default to these
+LOCAL_DIR = path('/var/cache/supr')
+# never shared; apt's lock and half-downloaded debs
+EXCLUDE = ('lock', 'partial')
+
+
+def evict(root, cap):
+    """
+    Delete the least recently used files under `root` until it's under
+    `cap` bytes. Use is tracked with mtime, which `artifactcache` refreshes
+    whenever a host has a file.
+    """
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for f in filenames:
+            s = os.stat(os.path.join(dirpath, f))
+            files.append((s.st_mtime, s.st_size, os.path.join(dirpath, f)))
+    total, evicted = 0, 0
+    for mtime, size, f in sorted(files, reverse=True):
+        total += size
+        if total > cap: os.unlink(f); evicted += 1
+    return evicted
+
+class artifactcache:
+    """
+    Wheels and debs built or downloaded once and shared by every host with
+    the same arch, `dist_release` and Python version. The shared copy lives
+    either on a mounted volume (`artifact_cache: {volume: files}`, e.g. s3fs)
+    or on the machine running supr (`artifact_cache: {local: ~/.supr/cache}`),
+    which is the supervisor when supr runs from its crontab. Evicted LRU
+    once it grows past `size`.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+        self.conf = instance.conf['artifact_cache']
+        assert 'volume' in self.conf or 'local' in self.conf, "artifact_cache needs volume or local"
+        self.cap = _megabytes(self.conf.get('size', '20G')) * 1024 * 1024
+        self._key = None
+    debs = property(lambda self: LOCAL_DIR/'debs')
+    wheels = property(lambda self: LOCAL_DIR/'wheels')
+    @property
+    def key(self) -> str:
+        # identical for every host that can use the same binaries
+        if not self._key:
+            self._key = self.instance.cmd(' '.join([
+                "echo $(uname -m)",
+                "$(. /etc/os-release && echo $VERSION_CODENAME)",
+                "py$(python3 -c 'import sys; print(*sys.version_info[:2], sep=\".\")')"]),
+                hide=True).stdout.strip().replace(' ', '-')
+        return self._key
+    @property
+    def store(self) -> path:
+        if 'local' in self.conf: return path(os.path.expanduser(self.conf['local']))/self.key
+        volume = self.instance.conf['volumes'][self.conf['volume']]
+        return path(volume['mount'])/'supr-cache'/self.key
+    def _mounted(self) -> bool:
+        # prewarmed and bake instances have no volumes; the mount point is just a directory there
+        mount = self.instance.conf['volumes'][self.conf['volume']]['mount']
+        if self.instance.cmd(f"mountpoint -q {mount}", hide=True, warn=True).ok: return True
+        log.info(f"[supr.cache] {self.instance.name}: {mount} isn't mounted, not sharing artifacts")
+        return False
+    def _rsync_opts(self):
+        return ' '.join(["-rt --ignore-existing"] + [f"--exclude={x}" for x in EXCLUDE])
+    def pull(self):
+        """
+        Copy everything in the shared store to this host.
+        """
+        i = self.instance
+        i.cmd(f"sudo mkdir -p {self.debs}/partial {self.wheels}")
+        i.cmd(f"sudo chown -R {i.user}:{i.group} {LOCAL_DIR}")
+        if 'local' not in self.conf and not self._mounted(): return
+        with span('cache', f"pull {self.store}", i.name):
+            if 'local' in self.conf:
+                if not self.store.exists(): return
+                i.rsync(f"{self.store}/", f"{LOCAL_DIR}/", rsync_opts=self._rsync_opts())
+            else:
+                i.cmd(f"mkdir -p {self.store} && rsync {self._rsync_opts()} {self.store}/ {LOCAL_DIR}/")
+    def push(self):
+        """
+        Add anything new on this host to the shared store, mark everything
+        it holds as recently used and evict down to `size`.
+        """
+        i = self.instance
+        if 'local' not in self.conf and not self._mounted(): return
+        with span('cache', f"push {self.store}", i.name):
+            if 'local' in self.conf:
+                self.store.mkdir(parents=True, exist_ok=True)
+                key_file = i.conf['key_pair']['file']
+                i.connection.local(' '.join([
+                    f"rsync {self._rsync_opts()}",
+                    f"-e 'ssh -i {key_file} {i.ssh_opts}'",
+                    f"{i.user}@{i.private_ip_address}:{LOCAL_DIR}/ {self.store}/"]), hide=True)
+                held = i.cmd(f"cd {LOCAL_DIR} && find . -type f", hide=True).stdout.split()
+                now = time.time()
+                for f in held:
+                    try: os.utime(self.store/f, (now, now))
+                    except OSError: pass
+                evicted = evict(self.store.parent, self.cap)
+            else:
+                i.cmd(f"rsync {self._rsync_opts()} {LOCAL_DIR}/ {self.store}/")
+                i.cmd(f"cd {LOCAL_DIR} && find . -type f ! -path './debs/partial/*' -print0 | "
+                    f"(cd {self.store} && xargs -0r touch -c)")
+                # newest first; everything past the cap goes
+                evicted = i.cmd(f"find {self.store.parent} -type f -printf '%T@ %s %p\\n' | sort -rn | "
+                    f"awk -v cap={self.cap} '(t += $2) > cap {{print $3}}' | xargs -r rm -fv",
+                    hide=True).stdout.count('\n')
+        if evicted: log.info(f"[supr.cache] evicted {evicted} files from {self.store.parent}")
@@ -1,14 +1,53 @@
-from supr import log, state, backend
-from supr.backend import F_ID, F_STATE
+import sys
+import time
+import subprocess
+from supr import CONF, LOG_PATH, log, state, backend
+from supr.backend import F_STATE, F_NAME, F_ACTIVE, POOL_SUFFIX
+from supr.utilization import idle_ids
 
-if __name__ == '__main__':
+
+def sweep() -> list:
+    """
+    Stop running instances that have been idle for longer than `IDLE_TIMEOUT`,
+    going by their utilization where the agent reports it.
+    """
     log.debug('[supr.cron] - checking for idle instances')
-    for _id in state.get_idle():
-        for i in backend.get_instances(F_ID[_id], F_STATE['running']):
-            if i.is_super: continue
-            if 'auto_stop' in i.conf and not i.conf['auto_stop']: continue
-            log.info(repr(i))
-            log.info("instance has been idle > IDLE_TIMEOUT")
-            i.stop()
-            log.info(repr(i))
+    t = time.time()
+    ids = idle_ids(state.idle_timeout.total_seconds()) if state.idle_timeout else []
+    running = backend.get_instances_by_id(ids, F_STATE['running']) if ids else []
+    idle = []
+    for i in running:
+        if i.is_super: continue
+        if 'auto_stop' in i.conf and not i.conf['auto_stop']: continue
+        # idle group members are scaled in, down to `min_size`
+        if i.member_index is not None and i.member_index < i.conf.get('min_size', 0): continue
+        log.info(repr(i))
+        log.info("instance has been idle > IDLE_TIMEOUT")
+        idle.append(i)
+    backend.stop_many(idle)
+    log.info(f"[supr.cron] stopped {' '.join(i.id for i in idle)}") if idle else None
+    log.info(f"[supr.cron] {len(ids)} idle, {len(running)} running, {len(idle)} stopped in {time.time() - t:.1f}s")
+    return idle
 
+def fill_pools():
+    """
+    Top up warm pools in the background; filling one takes longer than a cron interval.
+    """
+    for name, c in CONF.items():
+        if not isinstance(c, dict) or not c.get('warm_pool'): continue
+        if len(backend.get_instances(F_NAME[name + POOL_SUFFIX], F_ACTIVE)) >= c['warm_pool']: continue
+        log.info(f"[supr.cron] filling warm pool for {name}")
+        subprocess.Popen([sys.executable, '-m', 'supr', name, 'fill_pool'],
+            stdout=open(LOG_PATH, 'a'), stderr=subprocess.STDOUT, start_new_session=True)
+
+if __name__ == '__main__':
+    from supr import jobs
+    # hosts with running job items count as active, so dispatch before sweeping
+    jobs.tick()
+    state.recorder.flush()
+    from supr.utilization import collect
+    log.info(f"[supr.cron] collected {collect()} utilization samples")
+    sweep()
+    state.prune_spans(CONF['SPAN_RETENTION_DAYS'])
+    state.prune_samples(CONF['SAMPLE_RETENTION_DAYS'])
+    fill_pools()
@@ -0,0 +1,127 @@
+import os
+import time
+import uuid
+import shlex
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from supr import CONF, log, state
+from supr.spans import span
+from supr.backend import _rsync_stats, _hash_tree
+
+
+# for hops over the private network; hosts launched from the same image share host keys anyway
+RELAY_SSH_OPTS = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR"
+
+
+def _each(instances, fn):
+    if not instances: return []
+    with ThreadPoolExecutor(max_workers=min(len(instances), CONF['FLEET_WORKERS'] * 4)) as pool:
+        return list(pool.map(fn, instances))
+
+class distribution:
+    """
+    Copies `source` (a path relative to the working directory, like a
+    `local:` package) to every host by uploading it once to a seed host and
+    relaying it host to host over the private network: every round, each
+    host that has it sends it to up to `FANOUT_WIDTH` hosts that don't, so
+    the number of rounds grows with log(hosts) instead of hosts. Relays
+    authenticate with a keypair that only exists for the duration.
+    """
+    lock = threading.Lock()
+    def __init__(self, instances, source, width=None, seed=None):
+        self.instances = list(instances)
+        self.source = source.rstrip('/')
+        self.width = width or CONF['FANOUT_WIDTH']
+        self.seed = seed or self._seed()
+        self.tag = f"supr-fanout-{uuid.uuid4().hex[:8]}"
+        self.key = f".ssh/{self.tag}"
+        self.results = {}
+    def _seed(self):
+        from supr import backend
+        if not CONF['FANOUT_SEED']: return self.instances[0]
+        seed = backend.get_instance(CONF['FANOUT_SEED'])
+        assert seed, f"FANOUT_SEED {CONF['FANOUT_SEED']} not found"
+        return seed
+    hosts = property(lambda self: list({i.id: i for i in [self.seed] + self.instances}.values()))
+    def _authorize(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-C', self.tag,
+                '-f', os.path.join(tmp, 'key')], check=True)
+            with open(os.path.join(tmp, 'key.pub')) as f: public = f.read().strip()
+            def authorize(i):
+                i.cmd(f"mkdir -p ~/.ssh && echo {shlex.quote(public)} >> ~/.ssh/authorized_keys", hide=True)
+                i.put(os.path.join(tmp, 'key'), self.key)
+                i.cmd(f"chmod 600 {self.key}", hide=True)
+            _each(self.hosts, authorize)
+    def _revoke(self):
+        def revoke(i):
+            i.cmd(f"rm -f {self.key}; sed -i '/{self.tag}/d' ~/.ssh/authorized_keys", hide=True, warn=True)
+        _each(self.hosts, lambda i: self._try(revoke, i))
+    @staticmethod
+    def _try(fn, *args):
+        try: return fn(*args)
+        except Exception as e: log.warning(f"[supr.fanout] {e}")
+    def _report(self, src, dst, r, t):
+        files, sent = _rsync_stats(r.stdout)
+        dt = time.time() - t
+        with self.lock: print(f"{src} -> {dst.name}: {self.source} {files} files, {sent} bytes in {dt:.1f}s", flush=True)
+        self.results[dst.id] = (dst, True, r, dt)
+    def _upload(self):
+        t = time.time()
+        r = self.seed.rsync(self.source, '', delete=False, exclude=CONF['LOCAL_EXCLUDE'], rsync_opts='--stats')
+        self._report('local', self.seed, r, t)
+    def _relay(self, src, dst):
+        t = time.time()
+        try:
+            with span('relay', f"{self.source} {dst.name}", src.name):
+                r = src.cmd(f"rsync -a --stats -e 'ssh -i {self.key} {RELAY_SSH_OPTS}' "
+                    f"{self.source} {dst.user}@{dst.private_ip_address}:", hide=True)
+            self._report(src.name, dst, r, t)
+        except Exception as e:
+            log.error(f"[supr.fanout] {src.name} -> {dst.name}: {e}")
+            self.results[dst.id] = (dst, False, e, time.time() - t)
+    def run(self) -> list:
+        """
+        Returns `(instance, ok, result, seconds)` for every target, like `fleet.map`.
+        """
+        self._authorize()
+        try:
+            self._upload()
+            holders = [self.seed]
+            pending = [i for i in self.instances if i.id != self.seed.id]
+            rounds = 0
+            while pending and holders:
+                rounds += 1
+                hops = []
+                for src in holders:
+                    hops += [(src, dst) for dst in pending[:self.width]]
+                    pending = pending[self.width:]
+                _each(hops, lambda hop: self._relay(*hop))
+                holders = [i for i in self.hosts if self.results.get(i.id, (0, False))[1]]
+            log.info(f"[supr.fanout] {self.source} to {len(self.instances)} hosts in {rounds} rounds")
+        finally:
+            self._revoke()
+        return sorted([self.results.get(i.id, (i, False, RuntimeError("not reached"), 0))
+            for i in self.instances], key=lambda r: r[0].name)
+
+def relay_local(instances, stage):
+    """
+    Fan out the `local:` packages in `packages.<stage>` to the hosts that
+    don't have the current version, so `_install_local` only has to install.
+    """
+    by_source = {}
+    for i in instances:
+        for spec in i.conf.get('packages', {}).get(stage, ()):
+            if spec.startswith('local:'): by_source.setdefault(spec.split(':', 1)[1], []).append(i)
+    for source, targets in by_source.items():
+        tree, _ = _hash_tree(source, CONF['LOCAL_EXCLUDE'])
+        stale = [i for i in targets if (state.get_local_index(i.id, source) or (None, ))[0] != tree]
+        if len(stale) < 2: continue
+        try: results = distribution(stale, source).run()
+        except Exception as e:
+            # every host falls back to its own upload
+            log.warning(f"[supr.fanout] {source}: {e}"); continue
+        for i, ok, _, _ in results:
+            if ok: i._relayed = getattr(i, '_relayed', set()) | {source}
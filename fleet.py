@@ -0,0 +1,128 @@
+import time
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from supr import CONF, ANSI, log, backend
+from supr.backend import F, F_NAME, F_STATE, F_ACTIVE
+
+
+class fleet:
+    """
+    Runs instance methods across a set of instances on a bounded thread pool.
+    Targets are a name glob optionally followed by comma separated filters:
+    `compute-*`, `compute-*,state=running`, `*,tag:role=gpu,state=stopped|running`
+    """
+    commands = ('start', 'stop', 'init', 'deploy', 'hook', 'run', 'distribute',
+        'attach_volumes', 'install_base', 'install_crontab')
+    def __init__(self, instances, workers=None, target=None):
+        self.instances = instances
+        self.workers = workers or CONF['FLEET_WORKERS']
+        self.target = target
+    @classmethod
+    def select(cls, target):
+        pattern, *terms = target.split(',')
+        filters = [F_ACTIVE]
+        for t in terms:
+            k, _, v = t.partition('=')
+            assert v, f"invalid target filter {t}"
+            if k == 'state': filters[0] = F_STATE[v.split('|')]
+            elif k.startswith('tag:'): filters.append(F(k)[v.split('|')])
+            else: assert False, f"invalid target filter {t}"
+        if pattern not in ('', '*'): filters.append(F_NAME[pattern])
+        # backends are free to ignore filters; the glob is always applied
+        return cls([i for i in backend.get_instances(*filters) if fnmatch(i.name, pattern or '*')], target=target)
+    def map(self, fn):
+        """
+        Call `fn(instance)` for every instance; a failure on one host
+        doesn't affect the others. Returns `(instance, ok, result, seconds)`.
+        """
+        def call(i):
+            t = time.time()
+            try: return i, True, fn(i), time.time() - t
+            except Exception as e: return i, False, e, time.time() - t
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(call, i) for i in self.instances]
+            results = [f.result() for f in as_completed(futures)]
+        return sorted(results, key=lambda r: r[0].name)
+    def call(self, method, *args):
+        assert method in self.commands, f"{method} can't be run on a fleet"
+        match method:
+            case 'run': return self.stream(lambda i: ' '.join(args))
+            case 'hook': return self.hook(*args)
+            case 'start' | 'stop': return self.lifecycle(method)
+            case 'distribute': return self.distribute(*args)
+            case 'deploy' | 'install_base':
+                self.relay_local('app' if method == 'deploy' else 'base')
+                return self.map(lambda i: getattr(i, method)(*args))
+            case _: return self.map(lambda i: getattr(i, method)(*args))
+    # states `start_many`/`stop_many` accept for every instance in a request
+    _batchable = dict(start=('stopped', ), stop=('running', ))
+    def lifecycle(self, method):
+        """
+        `backend.start_many`/`stop_many` for the instances that can go in one
+        request per API batch. The rest, or all of them if a batch fails, go
+        through `map` so each host still gets its own outcome. Instances
+        already there are left alone.
+        """
+        t = time.time()
+        target = dict(start='running', stop='stopped')[method]
+        already = [(i, True, None, 0) for i in self.instances if i.state == target]
+        batch = [i for i in self.instances if i.state in self._batchable[method]]
+        try:
+            getattr(backend, f"{method}_many")(batch)
+            results = [(i, True, None, time.time() - t) for i in batch]
+        except Exception as e:
+            log.warning(f"[supr.fleet] batched {method} failed, retrying one at a time: {e}")
+            batch, results = [], []
+        def one(i):
+            if i.state in ('pending', 'stopping'): i.wait_for_state('running', 'stopped')
+            if i.state != target: getattr(i, method)()
+        done = {i.id for i, *_ in already + results}
+        rest = fleet([i for i in self.instances if i.id not in done], self.workers)
+        return sorted(already + results + rest.map(one), key=lambda r: r[0].name)
+    def stream(self, command):
+        """
+        Run `command(instance)` everywhere with output multiplexed into one 
+        prefixed stream; a non-zero exit counts as a failure.
+        """
+        from supr.stream import prefixed
+        out = prefixed([i.name for i in self.instances], CONF['STREAM_LOG_DIR'])
+        return self.map(lambda i: out(i, command(i)))
+    def distribute(self, source):
+        """
+        Copy `source` to every instance through a fan-out tree; see `supr.fanout`.
+        """
+        from supr.fanout import distribution
+        return distribution(self.instances, source).run()
+    def relay_local(self, stage):
+        from supr.fanout import relay_local
+        # a stopped host would hold up (and then fail) the whole tree
+        running = [i for i in self.instances if i.state == 'running']
+        if len(running) > 1: relay_local(running, stage)
+    def prepare(self) -> tuple[list, 'fleet']:
+        """
+        `prepare_hook` everywhere, relaying `local:` packages between the
+        hosts once they've started. Returns the results for hosts that
+        failed and a fleet of the ones that are ready.
+        """
+        started = self.map(lambda i: (i.start(), i.attach_volumes()))
+        up = fleet([i for i, ok, _, _ in started if ok], self.workers, self.target)
+        up.relay_local('app')
+        deployed = up.map(lambda i: i.deploy())
+        ready = fleet([i for i, ok, _, _ in deployed if ok], self.workers, self.target)
+        return [r for r in started + deployed if not r[1]], ready
+    def hook(self, cmd, *args):
+        failed, ready = self.prepare()
+        activate = lambda i: f"source {i.env}/bin/activate; "
+        return failed + ready.stream(lambda i: activate(i) + i.hook_command(cmd, *args))
+    @staticmethod
+    def summary(results):
+        if not results: print("no matching instances"); return
+        w = max(len(r[0].name) for r in results)
+        for i, ok, result, seconds in results:
+            print("{c}{status:<6}{RST} {BLD}{name:<{w}}{RST} {DIM}{seconds:>7.1f}s{RST} {detail}".format(
+                c=ANSI['GRN'] if ok else ANSI['RED'],
+                status='ok' if ok else 'failed',
+                name=i.name, w=w, seconds=seconds,
+                detail='' if ok else f"{type(result).__name__}: {result}", **ANSI))
+        failed = len([r for r in results if not r[1]])
+        print(f"{len(results) - failed}/{len(results)} succeeded")
@@ -0,0 +1,135 @@
+import time
+import uuid
+import shlex
+from collections import defaultdict
+from supr import ANSI, log, state
+from supr.fleet import fleet
+
+
+# per item working directory on the host, relative to $HOME
+RUN_DIR = '.supr/jobs'
+# tail of each item's output kept in the state database
+OUTPUT_BYTES = 64 * 1024
+# an item whose host disappears is requeued this many times
+MAX_ATTEMPTS = 3
+
+_dir = lambda job_id, item_no: f"$HOME/{RUN_DIR}/{job_id}/{item_no}"
+
+
+def launch(i, job_id, item_no, command, item=None):
+    """
+    Start one item detached from the SSH session; it writes its combined
+    output to `out` and its exit status to `exit` in its directory.
+    """
+    d = _dir(job_id, item_no)
+    cmd = f"source {i.env}/bin/activate; {command}" + (f" {shlex.quote(item)}" if item is not None else '')
+    script = f"({cmd}) > {d}/out 2>&1; echo $? > {d}/exit.tmp && mv {d}/exit.tmp {d}/exit"
+    i.cmd(f"mkdir -p {d} && rm -f {d}/exit && "
+        f"nohup setsid bash -c {shlex.quote(script)} > /dev/null 2>&1 < /dev/null & echo $! > {d}/pid", hide=True)
+
+def poll(i, job_id, item_nos) -> dict:
+    """
+    `{item_no: exit status | 'running' | 'lost'}` for items on `i`, in one round trip.
+    """
+    dirs = ' '.join(f"{item_no}:{_dir(job_id, item_no)}" for item_no in item_nos)
+    r = i.cmd(f"for x in {dirs}; do n=${{x%%:*}}; d=${{x#*:}}; "
+        "if [ -f $d/exit ]; then echo $n $(cat $d/exit); "
+        "elif kill -0 $(cat $d/pid 2>/dev/null) 2>/dev/null; then echo $n running; "
+        "else echo $n lost; fi; done", hide=True)
+    return {int(n): s if s in ('running', 'lost') else int(s)
+        for n, s in (line.split() for line in r.stdout.splitlines() if line.strip())}
+
+def output(i, job_id, item_no) -> str:
+    return i.cmd(f"tail -c {OUTPUT_BYTES} {_dir(job_id, item_no)}/out", hide=True, warn=True).stdout
+
+def submit(f, cmd, *args, items=None) -> str:
+    """
+    Prepare every host in fleet `f` like a hook, then queue hook `cmd` either
+    once per item (passed as the last argument, on whichever host is free)
+    or once on every host. Returns the job id; runs without a terminal.
+    """
+    assert items is None or items, "no items to run"
+    failed, prepared = f.prepare()
+    [log.error(f"[supr.jobs] {i.name}: {e}") for i, ok, e, _ in failed]
+    ready = prepared.instances
+    assert ready, "no hosts could be prepared"
+    job_id = uuid.uuid4().hex[:8]
+    command = ready[0].hook_command(cmd, *args)
+    if items is None: state.add_job(job_id, f.target, command, native_ids=[i.id for i in ready])
+    else: state.add_job(job_id, f.target, command, items=items)
+    tick(job_id)
+    return job_id
+
+def tick(job_id=None):
+    """
+    For every unfinished job: record items that have finished, requeue items
+    whose host went away, and start pending items on hosts with a free slot
+    (`job_slots` per host, default 1). Hosts with pinned items waiting for
+    them are prepared again. Run by the cron job and `supr jobs [id] wait`.
+    """
+    for job_id, target, command, *_ in state.get_jobs(job_id, 'running'):
+        selected = {i.id: i for i in fleet.select(target).instances}
+        hosts = {n: i for n, i in selected.items() if i.state == 'running'}
+        items = state.get_job_items(job_id)
+        waiting = defaultdict(list)
+        for item_no, _, native_id, pinned, status, *_ in items:
+            if pinned and status == 'pending' and native_id not in hosts: waiting[native_id].append(item_no)
+        for native_id in [n for n in waiting if n not in selected]:
+            for item_no in waiting.pop(native_id):
+                # no attempts left to give an item whose host is gone
+                state.release_job_item(job_id, item_no, 0, "host no longer exists")
+        for i, ok, e, _ in fleet([selected[n] for n in waiting]).map(lambda i: i.prepare_hook()):
+            if ok: hosts[i.id] = i
+            else: log.warning(f"[supr.jobs] {i.name}: {e}")
+        running = defaultdict(list)
+        for item_no, _, native_id, _, status, *_ in items:
+            if status == 'running': running[native_id].append(item_no)
+        for native_id in [n for n in running if n not in hosts]:
+            for item_no in running.pop(native_id):
+                state.release_job_item(job_id, item_no, MAX_ATTEMPTS, "host is no longer running")
+        def collect(i):
+            state.activity(i.id)
+            busy = 0
+            for item_no, s in poll(i, job_id, running[i.id]).items():
+                if s == 'running': busy += 1
+                elif s == 'lost': state.release_job_item(job_id, item_no, MAX_ATTEMPTS, "runner exited without a status")
+                else: state.finish_job_item(job_id, item_no, s, output(i, job_id, item_no))
+            return busy
+        # hosts that can't be polled get nothing new this time around
+        busy = {i.id: r if ok else float('inf') for i, ok, r, _ in fleet([hosts[n] for n in running]).map(collect)}
+        slots = {n: max(0, i.conf.get('job_slots', 1) - busy.get(n, 0)) for n, i in hosts.items()}
+        assigned = defaultdict(list)
+        for item_no, item, native_id, pinned, status, *_ in state.get_job_items(job_id):
+            if status != 'pending': continue
+            n = native_id if pinned else max(slots, key=slots.get, default=None)
+            if not slots.get(n): continue
+            if state.claim_job_item(job_id, item_no, n):
+                slots[n] -= 1
+                assigned[n].append((item_no, item))
+        def start(i):
+            for item_no, item in assigned[i.id]:
+                try: launch(i, job_id, item_no, command, item)
+                except Exception as e:
+                    state.release_job_item(job_id, item_no, MAX_ATTEMPTS, f"launch failed: {e}")
+        fleet([hosts[n] for n in assigned]).map(start)
+        state.finish_job(job_id)
+
+def report(job_id=None):
+    for job_id, target, command, created, status, total, done, failed, running in state.get_jobs(job_id):
+        print("{c}{status:<8}{RST} {BLD}{job_id}{RST} {target} {DIM}{created}{RST} "
+            "{done}/{total} done, {failed} failed, {running} running {ITL}{command}{RST}".format(
+            c=ANSI[dict(done='GRN', failed='RED').get(status, 'YEL')], status=status, job_id=job_id,
+            target=target, created=created, done=done, total=total, failed=failed, running=running,
+            command=command, **ANSI))
+
+def report_items(job_id):
+    for item_no, item, native_id, _, status, attempts, exit_code, started, finished in state.get_job_items(job_id):
+        print(f"{item_no:>5} {status:<8} {'' if exit_code is None else exit_code:>4} "
+            f"{native_id or '':<20} {attempts}x {item or ''}")
+
+def wait(job_id, interval=5):
+    while True:
+        tick(job_id)
+        report(job_id)
+        if state.get_jobs(job_id)[0][4] != 'running': return
+        time.sleep(interval)
@@ -0,0 +1,79 @@
+import os
+import threading
+from supr import POOL_PATH, log
+
+
+class poolerror(RuntimeError):
+    """
+    The daemon failed partway through a command, which may have run; unlike
+    `ConnectionError`, it's not safe to run again directly.
+    """
+
+class pool:
+    """
+    Optional local daemon that holds authenticated transports open so short
+    lived `supr` invocations don't pay for the TCP + SSH handshake on every
+    command. Start it with `supr pool`; `_instance.run` uses it when the
+    socket exists and falls back to a direct connection otherwise.
+    """
+    def __init__(self, path=POOL_PATH):
+        self.path = path
+        self.instances = {}
+        self.lock = threading.Lock()
+    @staticmethod
+    def available(path=POOL_PATH):
+        return os.path.exists(path)
+    @staticmethod
+    def run(native_id, cmd, **kwargs):
+        """
+        Run `cmd` on the pooled transport for `native_id`. Returns
+        `(stdout, stderr, exited)`. Raises `ConnectionError` when the daemon
+        isn't answering or couldn't find the host, `poolerror` when it failed
+        running the command.
+        """
+        from multiprocessing.connection import Client
+        try:
+            with Client(POOL_PATH, family='AF_UNIX') as c:
+                c.send((native_id, cmd, kwargs))
+                ok, r = c.recv()
+        except (OSError, EOFError) as e:
+            raise ConnectionError(f"pool unavailable: {e}")
+        if not ok: raise r
+        return r
+    def _instance(self, native_id):
+        from supr import backend
+        with self.lock:
+            if native_id not in self.instances:
+                i = backend.get_instance_by_id(native_id)
+                assert i, "no such instance"
+                self.instances[native_id] = i
+            return self.instances[native_id]
+    def _handle(self, c):
+        with c:
+            native_id, cmd, kwargs = c.recv()
+            try: i = self._instance(native_id)
+            except Exception as e:
+                c.send((False, ConnectionError(f"pool can't find {native_id}: {e}"))); return
+            try:
+                r = i.connection.run(cmd, env=i.vars, hide=True, warn=True, **kwargs)
+                c.send((True, (r.stdout, r.stderr, r.exited)))
+            except Exception as e:
+                log.warning(f"[supr.pool] {native_id}: {e}")
+                # drop the transport; it'll be re-established on the next request
+                self.instances.pop(native_id, None)
+                c.send((False, poolerror(str(e))))
+    def serve(self):
+        from multiprocessing.connection import Listener
+        if os.path.exists(self.path): os.unlink(self.path)
+        umask = os.umask(0o077)
+        try: listener = Listener(self.path, family='AF_UNIX')
+        finally: os.umask(umask)
+        print(f"pooling connections on {self.path} (^c to stop)")
+        try:
+            while True:
+                c = listener.accept()
+                threading.Thread(target=self._handle, args=(c, ), daemon=True).start()
+        except KeyboardInterrupt: pass
+        finally:
+            listener.close()
+            [i.connection.close() for i in self.instances.values()]
@@ -0,0 +1,38 @@
+import time
+import random
+from contextlib import contextmanager
+from supr import log
+
+
+def backoff(check, timeout=900, base=0.5, cap=15, what='condition'):
+    """
+    Call `check()` until it returns something truthy, sleeping with
+    exponential backoff and jitter in between. Raises `TimeoutError`.
+    """
+    t0, delay = time.time(), base
+    while True:
+        r = check()
+        if r: return r
+        if time.time() - t0 > timeout:
+            raise TimeoutError(f"timed out after {timeout}s waiting for {what}")
+        time.sleep(delay / 2 + random.uniform(0, delay / 2))
+        delay = min(cap, delay * 2)
+
+def port_open(host, port=22, timeout=2) -> bool:
+    """
+    Cheap TCP probe; lets us skip SSH handshakes that are bound to fail.
+    """
+    import socket
+    try:
+        with socket.create_connection((host, port), timeout=timeout): return True
+    except OSError: return False
+
+@contextmanager
+def timed(name, phase):
+    from supr.spans import span
+    t = time.time()
+    try:
+        with span('wait', phase, name): yield
+    finally:
+        dt = time.time() - t
+        log.info(f"[supr.ready] {name} {phase} {dt:.1f}s")
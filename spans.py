@@ -0,0 +1,87 @@
+import os
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from supr import ANSI
+
+# identifies the spans recorded by this process
+RUN = f"{os.getpid()}-{int(time.time())}"
+# phases reported on first, in this order; anything else traced follows
+PHASES = ('create', 'init', 'deploy', 'hook')
+_local = threading.local()
+
+def _current():
+    stack = getattr(_local, 'phases', None)
+    return stack[-1] if stack else (None, None)
+
+def _record(name, phase, kind, detail, start, seconds):
+    from supr import state
+    state.record_span(RUN, name, phase, kind, detail[:120], start, seconds)
+
+@contextmanager
+def span(kind, detail='', name=None):
+    """
+    Time one operation (a remote command, a transfer, an API call) and
+    attribute it to the phase running on this thread.
+    """
+    current_name, phase = _current()
+    t = time.time()
+    try: yield
+    finally: _record(name or current_name, phase, kind, detail, t, time.time() - t)
+
+@contextmanager
+def phase(name, phase):
+    if not hasattr(_local, 'phases'): _local.phases = []
+    _local.phases.append((name, phase))
+    t = time.time()
+    try: yield
+    finally:
+        _local.phases.pop()
+        _record(name, phase, 'phase', '', t, time.time() - t)
+
+def traced(phase_name):
+    """
+    Decorate an instance method (or a classmethod taking the name first)
+    to record it as a phase.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(obj, *args, **kwargs):
+            name = args[0] if isinstance(obj, type) else obj.name
+            with phase(name, phase_name): return fn(obj, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def before_call(context, **kwargs):
+    context['supr_span'] = time.time()
+
+def after_call(model, context, **kwargs):
+    """
+    botocore `after-call` hook; records every EC2 API call as a span.
+    """
+    if 'supr_span' not in context: return
+    name, phase = _current()
+    t = context.pop('supr_span')
+    _record(name, phase, 'aws', model.name, t, time.time() - t)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+def report(name=None, top=8):
+    from supr import state
+    rows = state.get_spans(name)
+    phases = {}
+    for phase, kind, detail, seconds in rows:
+        phases.setdefault(phase or '-', {}).setdefault((kind, detail), []).append(seconds)
+    order = [p for p in PHASES if p in phases] + sorted(set(phases) - set(PHASES))
+    print("{BLD}{:<10} {:>6} {:>9} {:>9}{RST}".format('phase', 'runs', 'p50', 'p95', **ANSI))
+    for p in order:
+        totals = phases[p].pop(('phase', ''), [])
+        print("{PNK}{BLD}{:<10}{RST} {:>6} {:>8.2f}s {:>8.2f}s".format(
+            p, len(totals), percentile(totals, 50), percentile(totals, 95), **ANSI))
+        ops = sorted(phases[p].items(), key=lambda o: -sum(o[1]))[:top]
+        for (kind, detail), seconds in ops:
+            print("  {DIM}{:<6}{RST} {:>6} {:>8.2f}s {:>8.2f}s {ITL}{:.60}{RST}".format(
+                kind, len(seconds), percentile(seconds, 50), percentile(seconds, 95), detail, **ANSI))
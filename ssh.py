@@ -0,0 +1,43 @@
+import time
+import fabric, paramiko
+
+
+class sshclient(paramiko.SSHClient):
+    """
+    Hacks paramiko to provide a callback for activity.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.activity_callback = lambda: None # override this
+    def connect(self, *args, **kwargs):
+        kwargs['transport_factory'] = self._get_transport_factory()
+        super().connect(*args, **kwargs)
+    def _get_transport_factory(self):
+        def wrap(original, callback):
+            last_call = time.time()
+            def _wrap(*args, **kwargs):
+                nonlocal last_call
+                # callback only records in memory; see `state.activityrecorder`
+                if time.time() - last_call > 1:
+                    callback()
+                    last_call = time.time()
+                return original(*args, **kwargs)
+            return _wrap
+        def factory(*args, **kwargs):
+            from paramiko.common import MSG_CHANNEL_DATA
+            transport = paramiko.transport.Transport(*args, **kwargs)
+            _feed = transport._channel_handler_table[MSG_CHANNEL_DATA]
+            transport._channel_handler_table[MSG_CHANNEL_DATA] = wrap(_feed, self.activity_callback)
+            return transport
+        return factory
+class connection(fabric.Connection):
+    """
+    Extends fabric.Connection to provide a callback for activity.
+    Pass your callback as `activity_callback` to the constructor.
+    """
+    def __init__(self, *args, **kwargs):
+        activity_callback = kwargs.pop('activity_callback', lambda: None)
+        super().__init__(*args, **kwargs)
+        self.client = sshclient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.activity_callback = activity_callback
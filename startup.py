@@ -0,0 +1,45 @@
+import sys
+import time
+import builtins
+
+
+class importprofile:
+    """
+    Attributes startup time to imports and named phases.
+    Enabled by passing `--profile-startup` to any command.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.t0 = self.last = time.perf_counter()
+        self.phases = []
+        self.imports = {}
+        self._stack = []
+        if enabled:
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed_import
+    def _timed_import(self, name, *args, **kwargs):
+        if name in sys.modules: return self._import(name, *args, **kwargs)
+        t = time.perf_counter()
+        self._stack.append(0.0)
+        try: return self._import(name, *args, **kwargs)
+        finally:
+            dt, nested = time.perf_counter() - t, self._stack.pop()
+            self.imports[name] = self.imports.get(name, 0) + dt - nested
+            if self._stack: self._stack[-1] += dt
+    def phase(self, name):
+        if not self.enabled: return
+        t = time.perf_counter()
+        self.phases.append((name, t - self.last))
+        self.last = t
+    def report(self, top=15):
+        if not self.enabled: return
+        builtins.__import__ = self._import
+        print(f"startup {(time.perf_counter() - self.t0) * 1000:.1f}ms")
+        for name, dt in self.phases:
+            print(f"  {name:<24} {dt * 1000:8.1f}ms")
+        packages = {}
+        for name, dt in self.imports.items():
+            packages[name.split('.')[0]] = packages.get(name.split('.')[0], 0) + dt
+        print("imports (self time by package)")
+        for name, dt in sorted(packages.items(), key=lambda x: -x[1])[:top]:
+            print(f"  {name:<24} {dt * 1000:8.1f}ms")
@@ -1,49 +1,288 @@
+import time
+import queue
 import sqlite3
-from datetime import timedelta
+import atexit
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
 from supr import log, CONF
 
 
+class writer:
+    """
+    Serializes every write to the database through one connection on one
+    thread. Whatever is queued when the thread wakes up is committed in a
+    single transaction; a failing batch is retried statement by statement
+    so one bad write doesn't take its neighbours down with it.
+    """
+    retries = 5
+    def __init__(self, filename, timeout):
+        self.filename = filename
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    def submit(self, sql, params=(), many=False) -> Future:
+        f = Future()
+        self.queue.put((sql, params, many, f))
+        return f
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(self.timeout)
+    @staticmethod
+    def _apply(db, sql, params, many):
+        if isinstance(sql, (list, tuple)): # statements that must commit together
+            return [db.execute(s, p).rowcount for s, p in sql]
+        return (db.executemany if many else db.execute)(sql, params).rowcount
+    def _execute(self, db, batch):
+        for _ in range(self.retries):
+            try:
+                with db:
+                    return [self._apply(db, sql, params, many) for sql, params, many, _ in batch]
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e): raise
+                log.warning(f"[supr.state] {e}, retrying")
+                time.sleep(0.1)
+        raise sqlite3.OperationalError("database is locked")
+    def _run(self):
+        db = sqlite3.connect(self.filename, timeout=self.timeout)
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            while True:
+                try: batch.append(self.queue.get_nowait())
+                except queue.Empty: break
+            closing = None in batch
+            batch = [b for b in batch if b is not None]
+            if not batch: continue
+            try:
+                for b, r in zip(batch, self._execute(db, batch)): b[3].set_result(r)
+            except sqlite3.Error:
+                for b in batch:
+                    try: b[3].set_result(self._execute(db, [b])[0])
+                    except sqlite3.Error as e: b[3].set_exception(e)
+        db.close()
+
+class activityrecorder:
+    """
+    Coalesces activity timestamps in memory per instance and writes them
+    to `instance_activity` from a single background thread, in one
+    transaction per `interval` and once more at exit.
+    """
+    interval = 5
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+    @contextmanager
+    def paused(self):
+        """
+        Ignore activity while supr itself talks to hosts, e.g. to collect samples.
+        """
+        self._paused = True
+        try: yield
+        finally: self._paused = False
+    _paused = False
+    def touch(self, native_id): # thread-safe, cheap enough to call per packet
+        if self._paused: return
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.pending[native_id] = now
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending: return
+        log.debug(f"activity {' '.join(pending)}")
+        self.writer.submit("""
+        INSERT INTO instance_activity (native_id, last_interacted)
+        VALUES (?, ?)
+        ON CONFLICT (native_id) DO UPDATE SET last_interacted=max(last_interacted, excluded.last_interacted)
+        """, list(pending.items()), many=True).result()
+
 class localstate:
     """
     State tracks instance activity and runtime.
+    The database runs in WAL mode so readers never block on the writer;
+    all writes go through a single `writer` thread.
     """
     idle_timeout = None
-    _schema = """
+    busy_timeout = 30
+    # append only; each entry (a script, or a callable for data migrations)
+    # runs once, in order, tracked by `PRAGMA user_version`
+    _migrations = (
+    """
     CREATE TABLE IF NOT EXISTS instance_runtime (
-        native_id text, 
-        start datetime, 
+        native_id text,
+        start datetime,
         stop datetime
     );
     CREATE INDEX IF NOT EXISTS idx_native_id ON instance_runtime(native_id);
     CREATE TABLE IF NOT EXISTS instance_activity (
-        native_id text primary key, 
+        native_id text primary key,
         last_interacted datetime
-    );"""
-    @classmethod
-    def activity_callback(cls, native_id): # thread-safe
-        from supr import DB_PATH
-        return lambda: cls(DB_PATH).activity(native_id)
+    );""",
+    """
+    CREATE TABLE IF NOT EXISTS local_index (
+        native_id text,
+        name text,
+        tree_hash text,
+        meta_hash text,
+        PRIMARY KEY (native_id, name)
+    );""",
+    """
+    ALTER TABLE instance_runtime ADD COLUMN name text;
+    ALTER TABLE instance_runtime ADD COLUMN hour_cost real;
+    ALTER TABLE instance_runtime ADD COLUMN rolled_up integer DEFAULT 0;
+    CREATE TABLE IF NOT EXISTS runtime_daily (
+        day date,
+        native_id text,
+        name text,
+        seconds real,
+        cost real,
+        PRIMARY KEY (day, native_id)
+    );""",
+    # roll up runtime recorded before `runtime_daily` existed
+    lambda self: [self.db.execute(sql, params) for sql, params in self._rollup_closed()],
+    """
+    CREATE TABLE IF NOT EXISTS spans (
+        run text,
+        name text,
+        phase text,
+        kind text,
+        detail text,
+        start datetime,
+        seconds real
+    );
+    CREATE INDEX IF NOT EXISTS idx_spans_name ON spans(name);
+    CREATE INDEX IF NOT EXISTS idx_spans_start ON spans(start);""",
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id text primary key,
+        target text,
+        command text,
+        created datetime,
+        status text
+    );
+    CREATE TABLE IF NOT EXISTS job_items (
+        job_id text,
+        item_no integer,
+        item text,
+        native_id text,
+        pinned integer DEFAULT 0,
+        status text DEFAULT 'pending',
+        attempts integer DEFAULT 0,
+        exit_code integer,
+        output text,
+        started datetime,
+        finished datetime,
+        PRIMARY KEY (job_id, item_no)
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);""",
+    """
+    CREATE TABLE IF NOT EXISTS utilization (
+        native_id text,
+        t datetime,
+        cpus integer,
+        cpu real,
+        gpus integer,
+        gpu real,
+        net real,
+        disk real,
+        PRIMARY KEY (native_id, t)
+    );
+    CREATE INDEX IF NOT EXISTS idx_utilization_t ON utilization(t);""",
+    """
+    CREATE TABLE IF NOT EXISTS pool_claims (
+        native_id text primary key,
+        name text,
+        claimed datetime
+    );""",
+    # runtime from before names were recorded; see `backfill_runtime`
+    """
+    CREATE TABLE IF NOT EXISTS runtime_backfill AS
+    SELECT DISTINCT native_id FROM instance_runtime WHERE name IS NULL;""",
+    )
+    # splits runtime rows matching `{where}` into per-day (day, native_id, name, seconds, cost)
+    _runtime_days = """
+    WITH RECURSIVE span(native_id, name, hour_cost, s, e) AS (
+        SELECT native_id, name, hour_cost, start, coalesce(stop, datetime('now'))
+        FROM instance_runtime WHERE {where}
+        UNION ALL
+        SELECT native_id, name, hour_cost, datetime(date(s), '+1 day'), e
+        FROM span WHERE datetime(date(s), '+1 day') < e
+    ), days AS (
+        SELECT date(s) AS day, native_id, name, hour_cost,
+            (julianday(min(e, datetime(date(s), '+1 day'))) - julianday(s)) * 24 * 60 * 60 AS seconds
+        FROM span
+    )
+    SELECT day, native_id, name, seconds, seconds / 60 / 60 * coalesce(hour_cost, 0) AS cost
+    FROM days"""
+    _rollup = """
+    INSERT INTO runtime_daily (day, native_id, name, seconds, cost)
+    SELECT * FROM ({days}) WHERE true
+    ON CONFLICT (day, native_id) DO UPDATE SET
+        seconds=seconds + excluded.seconds,
+        cost=cost + excluded.cost,
+        name=coalesce(excluded.name, name)"""
+    def activity_callback(self, native_id): # thread-safe
+        return lambda: self.recorder.touch(native_id)
     def __init__(self, filename, idle_timeout=None):
-        self.db = sqlite3.connect(filename, isolation_level=None)
-        self.db.executescript(self._schema)
+        # reads only; shared with `supr fleet` worker threads
+        self.db = sqlite3.connect(filename, isolation_level=None,
+            timeout=self.busy_timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.writer = writer(filename, self.busy_timeout)
+        self.recorder = activityrecorder(self.writer)
         if idle_timeout:
             self.idle_timeout = timedelta(minutes=idle_timeout)
+    def _rollup_closed(self, native_id=None):
+        # closed runtime rows are folded into `runtime_daily` exactly once
+        where = "stop IS NOT NULL AND NOT rolled_up" + (" AND native_id=?" if native_id else "")
+        params = (native_id, ) if native_id else ()
+        return [
+            (self._rollup.format(days=self._runtime_days.format(where=where)), params),
+            (f"UPDATE instance_runtime SET rolled_up=1 WHERE {where}", params), ]
+    def _migrate(self):
+        version = lambda: self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version() >= len(self._migrations): return
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have migrated while we waited for the lock
+            for v, script in enumerate(self._migrations[version():], version() + 1):
+                log.info(f"[supr.state] migrating to schema version {v}")
+                if callable(script): script(self)
+                else: [self.db.execute(sql) for sql in script.split(';') if sql.strip()]
+                self.db.execute(f"PRAGMA user_version={v}")
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+    def _write(self, sql, params=(), many=False):
+        return self.writer.submit(sql, params, many).result()
     def activity(self, native_id):
-        log.debug(f"activity {native_id}")
-        self.db.execute("""
-        INSERT INTO instance_activity (native_id, last_interacted) 
-        VALUES (?, current_timestamp)
-        ON CONFLICT (native_id) DO UPDATE SET last_interacted=current_timestamp
-        """, (native_id, ))
+        self.recorder.touch(native_id)
     def get_all(self):
-        return self.conn.execute("""
+        return self.db.execute("""
         SELECT native_id, last_interacted
-        FROM instance_activity 
+        FROM instance_activity
         """).fetchall()
     def get_idle(self):
         return self.db.execute("""
         SELECT native_id
-        FROM instance_activity 
+        FROM instance_activity
         WHERE last_interacted < datetime('now', '-%s seconds')
         """ % self.idle_timeout.total_seconds()) \
             .fetchall() if self.idle_timeout else []
@@ -53,17 +292,191 @@ class localstate:
         FROM instance_runtime
         GROUP BY native_id
         """).fetchall()
-    def change(self, native_id, state):
+    def backfill_runtime(self, describe):
+        """
+        Name and price runtime recorded before either was, once. `describe(ids)`
+        returns `{native_id: (name, hour_cost)}` for the ids the backend still
+        knows; the rest stay unnamed.
+        """
+        ids = [native_id for native_id, in self.db.execute("SELECT native_id FROM runtime_backfill")]
+        if not ids: return
+        writes = []
+        for native_id, (name, hour_cost) in describe(ids).items():
+            writes += [("""
+            UPDATE instance_runtime SET name=?, hour_cost=? WHERE native_id=? AND name IS NULL
+            """, (name, hour_cost, native_id)), ("""
+            UPDATE runtime_daily SET name=?, cost=seconds / 60 / 60 * coalesce(?, 0)
+            WHERE native_id=? AND name IS NULL
+            """, (name, hour_cost, native_id))]
+        self._write(writes + [("DELETE FROM runtime_backfill", ())])
+    def get_costs(self, since='0000-01-01', until='9999-12-31', by_name=False):
+        """
+        Runtime and cost between two dates (inclusive) per instance, or per 
+        name; rolled up days plus whatever is still running.
+        """
+        key = 'name' if by_name else 'native_id'
+        return self.db.execute(f"""
+        SELECT {key}, max(name), sum(seconds), sum(cost)
+        FROM (
+            SELECT day, native_id, name, seconds, cost FROM runtime_daily
+            UNION ALL
+            SELECT * FROM ({self._runtime_days.format(where="stop IS NULL")})
+        )
+        WHERE day BETWEEN ? AND ?
+        GROUP BY {key}
+        ORDER BY sum(cost) DESC
+        """, (since, until)).fetchall()
+    def record_span(self, run, name, phase, kind, detail, start, seconds):
+        # fire and forget; the writer commits spans along with whatever else is queued
+        self.writer.submit("""
+        INSERT INTO spans (run, name, phase, kind, detail, start, seconds)
+        VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'), ?)
+        """, (run, name, phase, kind, detail, start, seconds))
+    def get_spans(self, name=None):
+        return self.db.execute("""
+        SELECT phase, kind, detail, seconds
+        FROM spans
+        WHERE ? IS NULL OR name=?
+        """, (name, name)).fetchall()
+    def prune_spans(self, days):
+        self._write("DELETE FROM spans WHERE start < datetime('now', ?)", (f"-{days} days", ))
+    def claim_pool_instance(self, native_id, name, stale_minutes=10) -> bool:
+        """
+        Reserve a warm pool instance for `name`; true for exactly one caller
+        across every process sharing this database. A claim whose process
+        died before renaming the instance can be retaken after `stale_minutes`.
+        """
+        return self._write("""
+        INSERT INTO pool_claims (native_id, name, claimed)
+        VALUES (?, ?, current_timestamp)
+        ON CONFLICT (native_id) DO UPDATE SET name=excluded.name, claimed=excluded.claimed
+        WHERE claimed < datetime('now', ?)
+        """, (native_id, name, f"-{stale_minutes} minutes")) == 1
+    def add_job(self, job_id, target, command, items=(), native_ids=()):
+        """
+        Queue `command` once per item, to run on whichever host is free, 
+        or once on each of `native_ids`.
+        """
+        rows = [(job_id, n, item, None, 0) for n, item in enumerate(items)] + \
+            [(job_id, n, None, native_id, 1) for n, native_id in enumerate(native_ids)]
+        self._write([("""
+        INSERT INTO jobs (id, target, command, created, status)
+        VALUES (?, ?, ?, current_timestamp, 'running')
+        """, (job_id, target, command))] + [("""
+        INSERT INTO job_items (job_id, item_no, item, native_id, pinned)
+        VALUES (?, ?, ?, ?, ?)
+        """, row) for row in rows])
+    def get_jobs(self, job_id=None, status=None):
+        return self.db.execute("""
+        SELECT j.id, j.target, j.command, j.created, j.status, 
+            count(i.item_no), ifnull(sum(i.status='done'), 0), ifnull(sum(i.status='failed'), 0), 
+            ifnull(sum(i.status='running'), 0)
+        FROM jobs j LEFT JOIN job_items i ON i.job_id=j.id
+        WHERE (? IS NULL OR j.id=?) AND (? IS NULL OR j.status=?)
+        GROUP BY j.id
+        ORDER BY j.created
+        """, (job_id, job_id, status, status)).fetchall()
+    def get_job_items(self, job_id):
+        return self.db.execute("""
+        SELECT item_no, item, native_id, pinned, status, attempts, exit_code, started, finished
+        FROM job_items
+        WHERE job_id=?
+        ORDER BY item_no
+        """, (job_id, )).fetchall()
+    def get_job_output(self, job_id, item_no):
+        return self.db.execute("""
+        SELECT output FROM job_items WHERE job_id=? AND item_no=?
+        """, (job_id, item_no)).fetchone()
+    def claim_job_item(self, job_id, item_no, native_id) -> bool:
+        # conditional so concurrent dispatchers (cron, `supr jobs wait`) never double book
+        return self._write("""
+        UPDATE job_items
+        SET status='running', native_id=?, attempts=attempts + 1, started=current_timestamp
+        WHERE job_id=? AND item_no=? AND status='pending'
+        """, (native_id, job_id, item_no)) == 1
+    def finish_job_item(self, job_id, item_no, exit_code, output):
+        self._write("""
+        UPDATE job_items
+        SET status=CASE WHEN ?=0 THEN 'done' ELSE 'failed' END, exit_code=?, output=?, finished=current_timestamp
+        WHERE job_id=? AND item_no=?
+        """, (exit_code, exit_code, output, job_id, item_no))
+    def release_job_item(self, job_id, item_no, max_attempts, reason):
+        """
+        Put an item whose host went away back in the queue, unless it's been tried enough.
+        """
+        self._write("""
+        UPDATE job_items
+        SET status=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+            native_id=CASE WHEN pinned THEN native_id END,
+            output=?, finished=CASE WHEN attempts >= ? THEN current_timestamp END
+        WHERE job_id=? AND item_no=?
+        """, (max_attempts, reason, max_attempts, job_id, item_no))
+    def finish_job(self, job_id):
+        self._write("""
+        UPDATE jobs
+        SET status=CASE WHEN EXISTS (SELECT 1 FROM job_items WHERE job_id=jobs.id AND status='failed')
+            THEN 'failed' ELSE 'done' END
+        WHERE id=? AND NOT EXISTS (
+            SELECT 1 FROM job_items WHERE job_id=jobs.id AND status IN ('pending', 'running'))
+        """, (job_id, ))
+    def add_samples(self, native_id, samples):
+        # (unixtime, cpus, cpu, gpus, gpu, net, disk) from `supr.agent`
+        self._write("""
+        INSERT OR IGNORE INTO utilization (native_id, t, cpus, cpu, gpus, gpu, net, disk)
+        VALUES (?, datetime(?, 'unixepoch'), ?, ?, ?, ?, ?, ?)
+        """, [(native_id, *s) for s in samples], many=True)
+    def get_utilization(self, seconds, slack=180):
+        """
+        Average utilization per instance over the last `seconds`, and whether
+        samples cover that whole window (give or take `slack`).
+        """
+        return self.db.execute("""
+        SELECT native_id, min(t) <= datetime('now', ?), avg(cpu), avg(gpu), avg(net), avg(disk)
+        FROM utilization
+        WHERE t >= datetime('now', ?)
+        GROUP BY native_id
+        """, (f"-{seconds - slack} seconds", f"-{seconds} seconds")).fetchall()
+    def get_samples(self, name, days):
+        """
+        Samples from every instance that ran as `name`, its group members or
+        its warm pool in the last `days`.
+        """
+        return self.db.execute("""
+        SELECT u.cpus, u.cpu, u.gpus, u.gpu, u.net, u.disk
+        FROM utilization u
+        WHERE u.t >= datetime('now', ?2)
+            AND u.native_id IN (SELECT native_id FROM instance_runtime
+                WHERE name IN (?1, ?1 || '.pool') OR name GLOB ?1 || '-[0-9]*')
+        ORDER BY u.t
+        """, (name, f"-{days} days")).fetchall()
+    def prune_samples(self, days):
+        self._write("DELETE FROM utilization WHERE t < datetime('now', ?)", (f"-{days} days", ))
+    def get_local_index(self, native_id, name):
+        return self.db.execute("""
+        SELECT tree_hash, meta_hash
+        FROM local_index
+        WHERE native_id=? AND name=?
+        """, (native_id, name)).fetchone()
+    def set_local_index(self, native_id, name, tree_hash, meta_hash):
+        self._write("""
+        INSERT INTO local_index (native_id, name, tree_hash, meta_hash)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (native_id, name) DO UPDATE SET tree_hash=excluded.tree_hash, meta_hash=excluded.meta_hash
+        """, (native_id, name, tree_hash, meta_hash))
+    def clear_local_index(self, native_id):
+        self._write("DELETE FROM local_index WHERE native_id=?", (native_id, ))
+    def change(self, native_id, state, name=None, hour_cost=None):
         self.activity(native_id)
         if state == 'start':
-            self.db.execute("""
-            INSERT INTO instance_runtime (native_id, start) 
-            VALUES (?, current_timestamp)
-            """, (native_id, ))
+            # starting a running instance again doesn't open a second period
+            self._write("""
+            INSERT INTO instance_runtime (native_id, start, name, hour_cost)
+            SELECT ?1, current_timestamp, ?2, ?3
+            WHERE NOT EXISTS (SELECT 1 FROM instance_runtime WHERE native_id=?1 AND stop IS NULL)
+            """, (native_id, name, hour_cost))
         elif state in ('stop', 'terminate'):
-            self.db.execute("""
-            UPDATE instance_runtime 
-            SET stop=current_timestamp 
+            self._write([("""
+            UPDATE instance_runtime
+            SET stop=current_timestamp
             WHERE native_id=? AND stop IS NULL
-            """, (native_id, ))
-
+            """, (native_id, ))] + self._rollup_closed(native_id))
@@ -0,0 +1,68 @@
+import os
+import asyncio
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+from supr import CONF, ANSI
+
+
+def lines(instance, cmd):
+    """
+    Iterate `instance.stream(cmd)`; returns the exit status once exhausted.
+    """
+    it = instance.stream(cmd)
+    while True:
+        try: yield next(it)
+        except StopIteration as e: return e.value
+
+async def astream(instance, cmd, maxsize=1024):
+    """
+    asyncio interface to `instance.stream`; lines are read on a worker thread
+    and handed over through a bounded queue.
+    """
+    loop = asyncio.get_running_loop()
+    q, done = asyncio.Queue(maxsize), object()
+    def pump():
+        try:
+            for line in instance.stream(cmd):
+                asyncio.run_coroutine_threadsafe(q.put(line), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(q.put(done), loop).result()
+    f = loop.run_in_executor(None, pump)
+    while (line := await q.get()) is not done:
+        yield line
+    await f
+
+class prefixed:
+    """
+    Writes output from several hosts to one terminal as it arrives, each
+    line prefixed with its host, and optionally tees each host to a
+    rotating log file in `log_dir`.
+    """
+    colors = ('CYN', 'YEL', 'GRN', 'PNK', 'BLU', 'WHT')
+    lock = threading.Lock()
+    def __init__(self, names, log_dir=None):
+        self.width = max((len(n) for n in names), default=0)
+        self.color = {n: ANSI[self.colors[i % len(self.colors)]] for i, n in enumerate(sorted(names))}
+        self.log_dir = log_dir
+    def _log(self, name):
+        if not self.log_dir: return None
+        os.makedirs(self.log_dir, exist_ok=True)
+        l = logging.getLogger(f"supr.stream.{name}")
+        l.propagate = False
+        if not l.handlers:
+            l.addHandler(RotatingFileHandler(os.path.join(self.log_dir, f"{name}.log"),
+                maxBytes=CONF['STREAM_LOG_BYTES'], backupCount=CONF['STREAM_LOG_BACKUPS']))
+        l.setLevel(logging.INFO)
+        return l
+    def __call__(self, instance, cmd) -> int:
+        name, log = instance.name, self._log(instance.name)
+        prefix = "{}{:<{}}{RST} | ".format(self.color.get(name, ''), name, self.width, **ANSI)
+        it = lines(instance, cmd)
+        while True:
+            try: line = next(it)
+            except StopIteration as e: status = e.value; break
+            with self.lock: print(prefix + line, flush=True)
+            if log: log.info(line)
+        if status: raise RuntimeError(f"exited {status}")
+        return status
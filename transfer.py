@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import zlib
+import shlex
+import hashlib
+import threading
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from supr import CONF, log
+from supr.spans import span
+
+
+# bytes written to a channel at a time
+BLOCK = 1024 * 1024
+# a block that takes longer than this to send counts as a stall
+STALL = 5
+# attempts per chunk before the transfer gives up; rerunning resumes it
+RETRIES = 3
+
+
+def large_files(root, exclude, threshold) -> dict:
+    """
+    `{path: (size, mtime)}` for files under `root` at least `threshold` bytes.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not any(fnmatch(d, x) for x in exclude)]
+        for f in filenames:
+            if any(fnmatch(f, x) for x in exclude): continue
+            p = os.path.normpath(os.path.join(dirpath, f))
+            stat = os.stat(p)
+            if stat.st_size >= threshold: files[p] = (stat.st_size, int(stat.st_mtime))
+    return files
+
+class _gzip:
+    remote = 'gzip -dc'
+    def __init__(self): self.c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    def compress(self, data): return self.c.compress(data)
+    def flush(self): return self.c.flush()
+
+class _zstd:
+    remote = 'zstd -dcq'
+    def __init__(self):
+        import zstandard
+        self.c = zstandard.ZstdCompressor(level=3).compressobj()
+    def compress(self, data): return self.c.compress(data)
+    def flush(self): return self.c.flush()
+
+class _plain:
+    remote = 'cat'
+    def compress(self, data): return data
+    def flush(self): return b''
+
+class bulk:
+    """
+    Sends one large file over `BULK_STREAMS` SSH connections at once, in
+    `BULK_CHUNK` sized chunks, optionally compressed on the wire
+    (`BULK_COMPRESS: zstd|gzip`). Each chunk is written in place and its
+    sha256 checked on the host before it's recorded in `<remote>.supr-done`,
+    so an interrupted transfer picks up where it left off when it's rerun
+    with the same file. The finished file replaces `remote` atomically.
+    """
+    def __init__(self, instance, local, remote, streams=None, chunk=None, compress=None):
+        remote = str(remote)
+        if remote.endswith('/'): remote += os.path.basename(local)
+        self.instance, self.local, self.remote = instance, local, remote
+        self.streams = streams or CONF['BULK_STREAMS']
+        self.chunk = chunk or CONF['BULK_CHUNK']
+        self.compress = compress if compress is not None else CONF['BULK_COMPRESS']
+        stat = os.stat(local)
+        self.size, self.mtime = stat.st_size, int(stat.st_mtime)
+        self.partial, self.done = self.remote + '.supr-partial', self.remote + '.supr-done'
+        self.raw = self.sent = self.stalls = 0
+        self.stalled = 0.0
+        self.lock = threading.Lock()
+    chunks = property(lambda self: max(1, -(-self.size // self.chunk)))
+    @property
+    def header(self) -> str:
+        # a different source file (or chunking) invalidates what's on the host
+        return json.dumps(dict(size=self.size, mtime=self.mtime, chunk=self.chunk))
+    def _codec(self):
+        match self.compress:
+            case None | '' | False: return _plain()
+            case 'gzip': return _gzip()
+            case 'zstd':
+                try: return _zstd()
+                except ImportError: log.warning("[supr.transfer] zstandard isn't installed, using gzip")
+                return _gzip()
+            case _: assert False, f"invalid BULK_COMPRESS {self.compress}"
+    def _resume(self) -> set:
+        i = self.instance
+        r = i.cmd(f"cat {shlex.quote(self.done)}", hide=True, warn=True)
+        lines = r.stdout.splitlines() if r.ok else []
+        if lines and lines[0] == self.header:
+            return {int(n) for n in lines[1:] if n.strip().isdigit()}
+        i.cmd(f"rm -f {shlex.quote(self.partial)} && echo {shlex.quote(self.header)} > {shlex.quote(self.done)}", hide=True)
+        return set()
+    def _send(self, c, n):
+        offset = n * self.chunk
+        length = min(self.chunk, self.size - offset)
+        codec = self._codec()
+        partial = shlex.quote(self.partial)
+        cmd = ' && '.join([
+            f"{codec.remote} | dd of={partial} seek={offset} oflag=seek_bytes conv=notrunc bs={BLOCK} status=none",
+            f"tail -c +{offset + 1} {partial} | head -c {length} | sha256sum"])
+        digest = hashlib.sha256()
+        channel = c.client.get_transport().open_session()
+        channel.exec_command(cmd)
+        with open(self.local, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining:
+                data = f.read(min(BLOCK, remaining))
+                remaining -= len(data)
+                digest.update(data)
+                self._write(channel, codec.compress(data))
+            self._write(channel, codec.flush())
+        channel.shutdown_write()
+        with channel.makefile('r') as out: remote = out.read().decode().split()[:1]
+        status = channel.recv_exit_status()
+        assert status == 0, f"chunk {n} exited {status}"
+        assert remote == [digest.hexdigest()], f"chunk {n} checksum mismatch"
+        with self.lock: self.raw += length
+    def _write(self, channel, data):
+        if not data: return
+        t = time.time()
+        channel.sendall(data)
+        dt = time.time() - t
+        with self.lock:
+            self.sent += len(data)
+            if dt > STALL: self.stalls += 1; self.stalled += dt
+    def _worker(self, queue):
+        c = self.instance._connect()
+        c.open()
+        try:
+            while True:
+                with self.lock:
+                    if not queue: return
+                    n = queue.pop(0)
+                for attempt in range(RETRIES):
+                    try: self._send(c, n); break
+                    except (AssertionError, OSError, EOFError) as e:
+                        log.warning(f"[supr.transfer] {self.instance.name} chunk {n}: {e}")
+                        if attempt == RETRIES - 1: raise
+                        c.close()
+                        c = self.instance._connect()
+                        c.open()
+                self.instance.cmd(f"echo {n} >> {shlex.quote(self.done)}", hide=True)
+        finally:
+            c.close()
+    def run(self):
+        i, t = self.instance, time.time()
+        i.cmd(f"mkdir -p $(dirname {shlex.quote(self.remote)})", hide=True)
+        if self.compress == 'zstd' and not i.cmd("command -v zstd", hide=True, warn=True).ok:
+            log.warning(f"[supr.transfer] {i.name} has no zstd, using gzip"); self.compress = 'gzip'
+        verified = self._resume()
+        queue = [n for n in range(self.chunks) if n not in verified]
+        with span('bulk', f"{self.local} {self.remote}", i.name):
+            if queue:
+                with ThreadPoolExecutor(max_workers=min(self.streams, len(queue))) as pool:
+                    [f.result() for f in [pool.submit(self._worker, queue) for _ in range(min(self.streams, len(queue)))]]
+            if not self.size: i.cmd(f"touch {shlex.quote(self.partial)}", hide=True)
+            i.cmd(f"touch -m -d @{self.mtime} {shlex.quote(self.partial)} && "
+                f"mv {shlex.quote(self.partial)} {shlex.quote(self.remote)} && rm -f {shlex.quote(self.done)}", hide=True)
+        dt = time.time() - t
+        mb = self.size / 1024 / 1024
+        print(f"{i.name}: {self.local} {mb:.1f} MB in {dt:.1f}s, {mb / max(dt, 1e-6):.1f} MB/s, "
+            f"{self.sent / max(1, self.raw):.0%} on the wire, {len(verified)}/{self.chunks} chunks resumed, "
+            f"{self.stalls} stalls ({self.stalled:.1f}s)")
+        return self
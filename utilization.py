@@ -0,0 +1,66 @@
+from supr import CONF, log, state, backend
+from supr.backend import F_STATE
+
+
+def collect():
+    """
+    Pull and truncate `supr.agent` samples from every running instance.
+    Collecting doesn't count as activity, so it doesn't go through `supr pool`.
+    """
+    from supr.fleet import fleet
+    def pull(i):
+        r = i.cmd("cd .supr 2>/dev/null && [ -f samples ] && mv samples samples.pull && "
+            "cat samples.pull && rm samples.pull", hide=True, warn=True, pooled=False)
+        samples = [tuple(float(x) for x in line.split()) for line in r.stdout.splitlines()
+            if len(line.split()) == 7]
+        if samples: state.add_samples(i.id, samples)
+        return len(samples)
+    instances = [i for i in backend.get_instances(F_STATE['running']) if i.conf.get('agent', True)]
+    with state.recorder.paused():
+        results = fleet(instances, CONF['FLEET_WORKERS'] * 4).map(pull)
+    [log.warning(f"[supr.utilization] {i.name}: {e}") for i, ok, e, _ in results if not ok]
+    return sum(r for _, ok, r, _ in results if ok)
+
+def busy(cpu, gpu, net, disk) -> bool:
+    return cpu > CONF['IDLE_CPU'] or gpu > CONF['IDLE_GPU'] or \
+        net > CONF['IDLE_NET'] or disk > CONF['IDLE_DISK']
+
+def idle_ids(seconds) -> list[str]:
+    """
+    Instances nobody has interacted with for the last `seconds` and, where
+    samples cover the whole window, that weren't busy either.
+    """
+    working = {native_id for native_id, covered, *averages
+        in state.get_utilization(seconds) if covered and busy(*averages)}
+    return [_id for _id, in state.get_idle() if _id not in working]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+# aim for this much headroom on the busiest 5% of minutes
+TARGET = 0.7
+
+def rightsize(name, days=14):
+    """
+    Compare `name`'s recorded utilization with the entries under `sizes`
+    (which need `vcpus`, and `gpus` if any, alongside `hour_cost`) and
+    suggest the cheapest one that fits.
+    """
+    samples = state.get_samples(name, days)
+    if not samples: print(f"no utilization recorded for {name} in the last {days} days"); return
+    cpus, gpus = max(s[0] for s in samples), max(s[2] for s in samples)
+    cpu, gpu = percentile([s[1] for s in samples], 95), percentile([s[3] for s in samples], 95)
+    print(f"{name}: p95 cpu {cpu:.0f}% of {cpus} vcpus, p95 gpu {gpu:.0f}% of {gpus} gpus "
+        f"over {len(samples)} samples")
+    need_cpus = cpus * cpu / 100 / TARGET
+    need_gpus = 0 if gpu < CONF['IDLE_GPU'] else max(1, round(gpus * gpu / 100 / TARGET))
+    sizes = [(k, v) for k, v in CONF.get('sizes', {}).items() if isinstance(v, dict) and 'vcpus' in v]
+    fits = sorted([(v.get('hour_cost', 0), k, v) for k, v in sizes
+        if v['vcpus'] >= need_cpus and v.get('gpus', 0) >= need_gpus], key=lambda f: f[0])
+    if not fits: print(f"no entry under `sizes` with vcpus >= {need_cpus:.1f} and gpus >= {need_gpus}"); return
+    cost, size, conf = fits[0]
+    current = CONF[name].get('hour_cost')
+    saving = '' if current is None else f", saves ${current - cost:.3f}/h" if cost <= current \
+        else f", costs ${cost - current:.3f}/h more"
+    print(f"suggest {size} ({conf.get('aws:type', '?')}, ${cost}/h{saving})")